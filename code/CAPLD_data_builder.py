@@ -1,63 +1,58 @@
 import math
 from utils import *
-import re
 from config import *
+from corpus_scanner import scan_corpus, FrequencyAccumulator, ContentDiversityAccumulator, NON_CJK
+from enrichment import annotate
+from table_io import write_table
 
-cedict = load_char_def()
-def clean_text(text):
-    cleaned_text = re.sub(r'[^\u4e00-\u9fff]', '', text)
-    return cleaned_text
 
-# Initialize dictionaries to store character frequency and contextual diversity
-char_frequency = defaultdict(int)
-char_contextual_diversity = defaultdict(set)
-char_tone_rhyme = pingshui_dict()
-folder_path = CORPUS/'raw_corpus'
-if folder_path.exists():
-    paths=list(folder_path.iterdir())
-    for filename in paths :
-        if filename.suffix =='.csv':
-            file_path = os.path.join(folder_path, filename)
-            df = pd.read_csv(file_path, encoding='utf-8')
-            # Iterate through each row in the content column
-            for content in df['内容']:
-                cleaned_content = clean_text(content)
-                # Tokenize by character
-                for char in cleaned_content:
-                    char_frequency[char] += 1
-                    char_contextual_diversity[char].add(content)
+def generate_capld():
+    # Character frequency and contextual diversity over the whole raw corpus, in one pass
+    char_tone_rhyme = pingshui_dict()
+    folder_path = CORPUS/'raw_corpus'
+    frequency = FrequencyAccumulator(NON_CJK)
+    diversity = ContentDiversityAccumulator()
+    if folder_path.exists():
+        paths = [filename for filename in folder_path.iterdir() if filename.suffix == '.csv']
+        scan_corpus(paths, [frequency, diversity])
+    char_frequency = frequency.counts
+    char_contextual_diversity = dict(zip(char_frequency, diversity.count(char_frequency)))
 
-total_characters = sum(char_frequency.values())
-stroke_dict=get_stroke_count()
-result_data = {
-    'Character': [],
-    'Pinyin':[],
-    'Frequency': [],
-    'Log_frequency': [],
-    'Frequency_per_million': [],
-    'CD': [],
-    'Log_CD': [],
-    'Strokes': [],
-    'PSY_Tone': [],
-    'PSY_Rhyme': [],
-    'Gloss':[]
-}
+    total_characters = sum(char_frequency.values())
+    annotations = annotate(char_frequency)
+    result_data = {
+        'Character': [],
+        'Pinyin':[],
+        'Frequency': [],
+        'Log_frequency': [],
+        'Frequency_per_million': [],
+        'CD': [],
+        'Log_CD': [],
+        'Strokes': [],
+        'PSY_Tone': [],
+        'PSY_Rhyme': [],
+        'Gloss':[]
+    }
 
-for char, freq in char_frequency.items():
-    result_data['Character'].append(char)
-    result_data['Pinyin'].append(get_pinyin(char))
-    result_data['Frequency'].append(freq)
-    result_data['Log_frequency'].append(math.log(freq,10) if freq > 0 else 0)
-    result_data['Frequency_per_million'].append((freq / total_characters) * 1e6)
-    result_data['CD'].append(len(char_contextual_diversity[char]))
-    result_data['Log_CD'].append(math.log(len(char_contextual_diversity[char]),10) if len(char_contextual_diversity[char]) > 0 else 0)
-    result_data['Strokes'].append(stroke_dict.get(char,-1))
-    result_data['PSY_Tone'].append('|'.join(char_tone_rhyme[char]['tone']))
-    result_data['PSY_Rhyme'].append('|'.join(char_tone_rhyme[char]['rhymes']))
-    result_data['Gloss'].append(cedict.get(char,'-'))
+    for (char, freq), (pinyin, strokes, gloss) in zip(char_frequency.items(), annotations.itertuples(index=False)):
+        cd = char_contextual_diversity[char]
+        result_data['Character'].append(char)
+        result_data['Pinyin'].append(pinyin)
+        result_data['Frequency'].append(freq)
+        result_data['Log_frequency'].append(math.log(freq,10) if freq > 0 else 0)
+        result_data['Frequency_per_million'].append((freq / total_characters) * 1e6)
+        result_data['CD'].append(cd)
+        result_data['Log_CD'].append(math.log(cd,10) if cd > 0 else 0)
+        result_data['Strokes'].append(strokes)
+        result_data['PSY_Tone'].append('|'.join(char_tone_rhyme[char]['tone']))
+        result_data['PSY_Rhyme'].append('|'.join(char_tone_rhyme[char]['rhymes']))
+        result_data['Gloss'].append(gloss)
 
-if __name__ == "__main__":
     result_df = pd.DataFrame(result_data)
     df_sorted = result_df.sort_values(by='Frequency', ascending=False)
-    df_sorted.to_csv(ROOT.parent/'CAPLD.csv', index=False, encoding='utf-8-sig')
-    print("The CAPLD corpus has been generated and saved to 'CAPLD.csv'.")
\ No newline at end of file
+    write_table(df_sorted, ROOT.parent/'CAPLD.csv', index=False, encoding='utf-8-sig')
+    print("The CAPLD corpus has been generated and saved to 'CAPLD.csv'.")
+    return df_sorted
+
+if __name__ == "__main__":
+    generate_capld()
@@ -2,43 +2,39 @@
 import csv
 from collections import Counter
 import numpy as np
+from scipy import sparse
 from gensim.models import Word2Vec
 from utils import *
+from corpus_scanner import scan_dynasty, scan_dynasties, period_paths, is_chinese, FrequencyAccumulator
+from stage_cache import stage_key, is_fresh, mark_done
 from opencc import OpenCC
 import string
 import re
+import argparse
+from enrichment import annotate
+from table_io import write_table, read_table
 
-cedict = load_char_def()
+CHAR_VOCAB_VERSION = 1  # part of the stage key of Char_vocab_{dy}.csv: bump when its content changes
 
 
-
-def generate_dynasty_char_vocab():
-    # generate char_vocabulary for each dynasty
-    chinese_pattern = re.compile(r'[^\u4e00-\u9fa5]')
-
-    dynasty = 'Tang Song Yuan Ming Qing'.split()
-    path = SOURCE/'corpus'/'dynasty_corpus'
-    for dy in dynasty:
-        dy_path=path / f'{dy}.csv'
-        corpus_dynasty = ""
-
-        pd_dy = pd.read_csv(dy_path)
-        for idx,row in pd_dy.iterrows():
-
-            content = str(row['内容'])
-            content_clean = chinese_pattern.sub('', content)
-            corpus_dynasty += content_clean
-
-        char_counter = Counter(corpus_dynasty)
+def generate_dynasty_char_vocab(jobs=1):
+    # generate char_vocabulary for each configured period (config.PERIODS)
+    dynasty = DYNASTIES
+    # only the periods whose corpus changed since the last build are rewritten
+    keys = {dy: stage_key(*period_paths(dy), FrequencyAccumulator.version, CHAR_VOCAB_VERSION) for dy in dynasty}
+    stale = [dy for dy in dynasty if not is_fresh(f'char_vocab_{dy}', keys[dy], [OUTPUT / f'Char_vocab_{dy}.csv'])]
+    scan_dynasties(stale, ['frequency'], jobs)
+    for dy in stale:
+        char_counter = scan_dynasty(dy, ['frequency'])['frequency'].counts
 
         char_vocab_sorted = char_counter.most_common()
 
 
         csv_file =OUTPUT / f'Char_vocab_{dy}.csv'
-        with open(csv_file, 'w', newline='', encoding='utf-8') as csvfile:
-            csv_writer = csv.writer(csvfile)
-            csv_writer.writerow(['Character', 'Frequency'])
-            csv_writer.writerows(char_vocab_sorted)
+        # same bytes as the csv module wrote before, plus the Parquet copy
+        vocab_df = pd.DataFrame(char_vocab_sorted, columns=['Character', 'Frequency'])
+        write_table(vocab_df, csv_file, index=False, lineterminator='\r\n')
+        mark_done(f'char_vocab_{dy}', keys[dy])
 
         print(f"Sorted character vocabulary saved to {csv_file}")
 
@@ -47,15 +43,15 @@ def generate_dynasty_char_vocab():
 
 def generate_diachronic_characters_frequency():
     # Define the list of dynasties
-    dynasties = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
+    dynasties = DYNASTIES
     # Initialize a dictionary to store the vocabulary data for each dynasty
     dynasty_data = {}
 
     dy_total={}
     for dy in dynasties:
-        file_path =OUTPUT / f'char_vocab_{dy}.csv'  # Assume the file path
+        file_path =OUTPUT / f'Char_vocab_{dy}.csv'  # Assume the file path
         if os.path.exists(file_path):
-            df = pd.read_csv(file_path)
+            df = read_table(file_path, ['Character', 'Frequency'])
             # Convert the data to a dictionary with Character as key and Frequency as value
             dynasty_data[dy] = df.set_index('Character')['Frequency'].to_dict()
             dy_total[dy]=df['Frequency'].sum()
@@ -68,31 +64,31 @@ def generate_diachronic_characters_frequency():
     for dy in dynasties[1:]:
         common_characters = common_characters.intersection(set(dynasty_data[dy].keys()))
     # common_characters =common_characters.intersection(subtlex.keys())
+    common_characters = list(common_characters)
+    annotations = annotate(common_characters)
     result_data = []
-    for char in common_characters:
+    for char, pinyin, gloss in zip(common_characters, annotations['Pinyin'], annotations['Gloss']):
         raw_frequencies = [dynasty_data[dy].get(char, 0) for dy in dynasties]
         per_million_frequencies = [
             freq / dy_total[dy] * 1_000_000 if dy_total[dy] else 0 for freq, dy in zip(raw_frequencies, dynasties)
         ]
         # raw_sub = subtlex[char]['Frequency']
         # pmillion_sub =  subtlex[char]['Frequency_million']
-        pinyin = get_pinyin(char)
-        gloss=cedict.get(char, '-')
         result_data.append([pinyin,*raw_frequencies,*per_million_frequencies,gloss])
 
     # Create a DataFrame from the result list
-    columns = ['pinyin','Raw_Tang', 'Raw_Song', 'Raw_Yuan', 'Raw_Ming', 'Raw_Qing',
-               'PerMillion_Tang', 'PerMillion_Song', 'PerMillion_Yuan', 'PerMillion_Ming', 'PerMillion_Qing','Gloss']
-    result_df = pd.DataFrame(result_data, index=list(common_characters), columns=columns)
-    result_df = result_df.sort_values(by='Raw_Tang', ascending=False)
+    columns = ['pinyin'] + [f'Raw_{dy}' for dy in dynasties] + [f'PerMillion_{dy}' for dy in dynasties] + ['Gloss']
+    result_df = pd.DataFrame(result_data, index=common_characters, columns=columns)
+    result_df = result_df.sort_values(by=f'Raw_{dynasties[0]}', ascending=False)
     output_file = ROOT.parent/'Diachronic_sub-database' /'Diachronic_data'/'Diachronic_character_frequencies.csv'
-    result_df.to_csv(output_file, index_label='Character')
+    write_table(result_df, output_file, index_label='Character')
     return result_df
 
 
-def generate_diachronic_diversity():
+def generate_diachronic_diversity(jobs=1):
     # Define the list of dynasties
-    dynasties = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
+    dynasties = DYNASTIES
+    scan_dynasties(dynasties, ['diversity'], jobs)
     freq_df=generate_diachronic_characters_frequency()
     common_characters=freq_df.index.tolist()
     pinyin=freq_df['pinyin']
@@ -100,20 +96,14 @@ def generate_diachronic_diversity():
 
     dynasty_diversity = {}
     for dy in dynasties:
-        file_path = CORPUS / 'dynasty_corpus' / f'{dy}.csv'
         column_name = f'{dy}_diversity'
-        if not os.path.exists(file_path):
-            print(f'跳过：{file_path} 不存在')
+        if not period_paths(dy):
+            print(f'跳过：{dy} 没有语料')
             dynasty_diversity[column_name] = pd.Series(0, index=common_characters, name=column_name)
             continue
 
-        dynasty_diversity[column_name]={c:0 for c in common_characters}
-        poems_df = pd.read_csv(file_path)
-        for _, row in poems_df.iterrows():
-            text = str(row['内容'])
-            for char in common_characters:
-                if char in text:
-                    dynasty_diversity[column_name][char] += 1
+        poem_counts = scan_dynasty(dy, ['diversity'])['diversity'].count(common_characters)
+        dynasty_diversity[column_name] = pd.Series(poem_counts, index=common_characters, name=column_name)
 
     dynasty_df = pd.DataFrame(dynasty_diversity)
     result_df = pd.DataFrame({'Character':common_characters,'pinyin':pinyin,'gloss':gloss})
@@ -123,16 +113,16 @@ def generate_diachronic_diversity():
     result_df = result_df[columns_order]
     result_df = pd.DataFrame(result_df)
     output_file = ROOT.parent / 'Diachronic_sub-database' /'Diachronic_data' / 'Diachronic_character_contextual_diversities.csv'
-    result_df.to_csv(output_file, index=False)
+    write_table(result_df, output_file, index=False)
 
 
 def generate_diachronic_character_phonology():
     dynasties = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing', 'Subtlex']
     # Load the frequency dataframe
     freq_df_path= ROOT.parent /'Diachronic_sub-database' / 'Diachronic_data' /'Diachronic_character_frequencies.csv'
-    freq_df = pd.read_csv(freq_df_path)
+    freq_df = read_table(freq_df_path, ['Character', 'pinyin', 'Gloss'])
     # Load the CAPLD dataframe
-    capld = pd.read_csv(ROOT.parent / 'CAPLD.csv')
+    capld = read_table(ROOT.parent / 'CAPLD.csv', ['Character', 'PSY_Tone', 'PSY_Rhyme'])
     # Load the Guangyun dataframe
     guangyun = guangyun_data()
     # Get the list of common characters
@@ -140,44 +130,25 @@ def generate_diachronic_character_phonology():
     # Extract pinyin and gloss from the frequency dataframe
     pinyin = freq_df['pinyin']
     gloss = freq_df['Gloss']
-    # Initialize lists to store the extracted data
-    tone = []
-    psy_rhyme = []
-    gy_rhyme = []
-    gy_tone= []
-    gy_ID=[]
-    # Initialize the OpenCC converter for traditional to simplified characters
+    # Index CAPLD and Guangyun by character, keeping the first row as the lookups did
+    capld_index = capld.drop_duplicates('Character').set_index('Character')
+    guangyun_index = guangyun.drop_duplicates('CHARACTER').set_index('CHARACTER')
+    psy = capld_index.reindex(common_characters)
+    tone = psy['PSY_Tone'].values
+    psy_rhyme = psy['PSY_Rhyme'].values
+
+    # Characters missing from Guangyun are looked up by their traditional form,
+    # converted in one OpenCC call (one character per line)
     converter = OpenCC('s2t')
-    # Iterate over the common characters
-    for char in common_characters:
-        # Find the row in CAPLD that matches the current character
-        capld_row = capld[capld['Character'] == char]
-        if not capld_row.empty:
-            tone.append(capld_row['PSY_Tone'].values[0])
-            psy_rhyme.append(capld_row['PSY_Rhyme'].values[0])
-        else:
-            tone.append(None)
-            psy_rhyme.append(None)
-        # Find the row in Guangyun that matches the current character
-        guangyun_row = guangyun[guangyun['CHARACTER'] == char]
-        if guangyun_row.empty:
-            traditional_char = converter.convert(char)
-            guangyun_row = guangyun[guangyun['CHARACTER'] == traditional_char]
-        if not guangyun_row.empty:
-            gy_id=guangyun_row['CHARACTER_ID'].values[0]
-            gyr=guangyun_row['RHYME_ID'].values[0]
-            gy_rhyme.append(gyr)
-            gy_ID.append(gy_id)
-
-            if gyr[:2] in ['sp','xp']:
-                gy_tone.append('level')
-            else:
-                gy_tone.append('oblique')
-        else:
-            # If the character is not found, append None or a default value
-            gy_rhyme.append(None)
-            gy_tone.append(None)
-            gy_ID.append(None)
+    lookup = common_characters.copy()
+    missing = ~lookup.isin(guangyun_index.index)
+    if missing.any():
+        lookup[missing] = converter.convert('\n'.join(lookup[missing])).split('\n')
+    gy = guangyun_index.reindex(lookup)
+    gy_ID = gy['CHARACTER_ID'].values
+    gy_rhyme = gy['RHYME_ID'].values
+    gy_tone = np.where(gy['RHYME_ID'].isna(), None,
+                       np.where(gy['RHYME_ID'].astype(str).str[:2].isin(['sp', 'xp']), 'level', 'oblique'))
 
     # Create a new dataframe with the extracted data
     new_df = pd.DataFrame({
@@ -192,55 +163,94 @@ def generate_diachronic_character_phonology():
     })
 
     save_path= ROOT.parent / 'Diachronic_sub-database'/ 'Diachronic_data' / 'Diachronic_Character_Phonology.csv'
-    new_df.to_csv(save_path, index=False)
+    write_table(new_df, save_path, index=False)
 
     return new_df
 
 
 
+def generate_diachronic_rhyme_positions(jobs=1):
+    """
+    How often each character ends a line and stands in the rhyme position (the end of the
+    second line of a couplet) per period, from the parsed lines of the corpus scanner, and
+    the rhyme-position counts of every Pingshui rhyme group (a character listed under
+    several PSY_Rhyme groups counts in each).
+    """
+    dynasties = DYNASTIES
+    scan_dynasties(dynasties, ['position'], jobs)
+    freq_df_path = ROOT.parent / 'Diachronic_sub-database' / 'Diachronic_data' / 'Diachronic_character_frequencies.csv'
+    freq_df = read_table(freq_df_path, ['Character', 'pinyin'])
+    common_characters = freq_df['Character'].tolist()
+
+    capld = read_table(ROOT.parent / 'CAPLD.csv', ['Character', 'PSY_Rhyme']).dropna()
+    capld = capld[capld['Character'].map(lambda char: len(char) == 1 and is_chinese(char))]
+    groups = capld.assign(PSY_Rhyme=capld['PSY_Rhyme'].str.split('|')).explode('PSY_Rhyme')
 
-def generate_co_occurrence_matrix():
-    chinese_pattern = re.compile(r'[^\u4e00-\u9fa5]')
-    dynasties = [ 'Tang', 'Song', 'Yuan', 'Ming','Qing']
+    result_df = pd.DataFrame({'Character': common_characters, 'pinyin': freq_df['pinyin']})
+    group_df = pd.DataFrame({'PSY_Rhyme': groups['PSY_Rhyme'].values})
+    for dy in dynasties:
+        positions = scan_dynasty(dy, ['position'])['position']
+        result_df[f'{dy}_line_end'] = positions.count(common_characters, 'line_end')
+        result_df[f'{dy}_rhyme'] = positions.count(common_characters)
+        group_df[dy] = positions.count(groups['Character'].tolist())
+    group_df = group_df.groupby('PSY_Rhyme', sort=False).sum().reset_index()
+
+    save_dir = ROOT.parent / 'Diachronic_sub-database' / 'Diachronic_data'
+    write_table(result_df, save_dir / 'Diachronic_character_rhyme_positions.csv', index=False)
+    write_table(group_df, save_dir / 'Diachronic_PSY_rhyme_frequencies.csv', index=False)
+    print(f"Rhyme position data has been saved to {save_dir}")
+
+
+def generate_co_occurrence_matrix(export_csv=False, jobs=1):
+    """
+    Bigram co-occurrence matrix of each dynasty over the characters with Frequency > 10.
+    Saved as a scipy.sparse .npz with its vocabulary index (row/column order);
+    export_csv additionally writes the dense CSV of earlier releases.
+    """
+    dynasties = DYNASTIES
+    save_dir = ROOT.parent / 'Diachronic_sub-database' / 'bigram_cooccurrence_matrices'
+    save_dir.mkdir(parents=True, exist_ok=True)
+    scan_dynasties(dynasties, ['bigram'], jobs)
 
     for dy in dynasties:
         print(dy+' is processing')
         dy_vocab_path=OUTPUT / f'Char_vocab_{dy}.csv'
-        vocab_df = pd.read_csv(dy_vocab_path)
+        vocab_df = read_table(dy_vocab_path)
 
         filtered_vocab_df = vocab_df[vocab_df["Frequency"] > 10]
 
         characters = filtered_vocab_df["Character"].tolist()
+        co_occurrence_matrix = scan_dynasty(dy, ['bigram'])['bigram'].submatrix(characters)
 
-        co_occurrence_matrix = pd.DataFrame(
-            data=np.zeros((len(characters), len(characters)), dtype=int),
-            index=characters,
-            columns=characters
-        )
-
-        dir_path = CORPUS / 'dynasty_corpus' / f'{dy}.csv'
-
-        each_dy_poems = pd.read_csv(dir_path)
-        for _, row in each_dy_poems.iterrows():
-            text = str(row["内容"])
-            for i in range(len(text) - 1):
-                first_char = text[i]
-                second_char = text[i + 1]
-
-                if first_char in characters and second_char in characters:
-                    co_occurrence_matrix.loc[first_char, second_char] += 1
+        sparse.save_npz(save_dir / f'co_occurrence_{dy}.npz', co_occurrence_matrix)
+        write_table(filtered_vocab_df, save_dir / f'co_occurrence_{dy}_vocab.csv', index=False)
+        if export_csv:
+            pd.DataFrame(co_occurrence_matrix.toarray(), index=characters, columns=characters).to_csv(save_dir / f'co_occurrence_{dy}.csv')
+        print(dy + ' now has been saved to ' + str(save_dir))
 
 
-        save_path= ROOT.parent / 'Diachronic_sub-database' / 'bigram_cooccurrence_matrices' / f'co_occurrence_{dy}.csv'
-        co_occurrence_matrix.to_csv(save_path)
-        print(dy + ' now has been saved to csv file ')
+def load_co_occurrence_matrix(dy):
+    """
+    :return: The sparse co-occurrence matrix of a dynasty and its characters, in row order
+    """
+    save_dir = ROOT.parent / 'Diachronic_sub-database' / 'bigram_cooccurrence_matrices'
+    characters = read_table(save_dir / f'co_occurrence_{dy}_vocab.csv', ['Character'])['Character'].tolist()
+    return sparse.load_npz(save_dir / f'co_occurrence_{dy}.npz'), characters
 
 if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for the corpus scans')
+    parser.add_argument('--export-csv', action='store_true',
+                        help='also write the dense co-occurrence CSVs of earlier releases')
+    args = parser.parse_args()
+    # one scan per dynasty for all the counts below
+    scan_dynasties(DYNASTIES, ['frequency', 'diversity', 'bigram', 'position'], args.jobs)
     generate_dynasty_char_vocab()
     generate_diachronic_characters_frequency()
     generate_diachronic_diversity()
     generate_diachronic_character_phonology()
-    generate_co_occurrence_matrix()
+    generate_diachronic_rhyme_positions()
+    generate_co_occurrence_matrix(args.export_csv)
 
 
 
@@ -0,0 +1,161 @@
+import hashlib
+import numpy as np
+from config import *
+from stage_cache import stage_key, load_result, save_result
+from table_io import read_table
+
+# Orthogonal alignment of several embedding spaces, shared by the similarity builder
+# (embedding_alignment.align_embedding_space) and the evaluator (embedding_eval):
+#   reference    every space is rotated onto the reference space
+#   chained      every space onto its neighbor towards the reference (Song -> Tang,
+#                Yuan -> Song, ...), the rotations composed along the chain
+#   generalized  generalized Procrustes: every space onto their common mean, iterated
+#                until the mean settles
+# All rotations of a fit come from one batched SVD per step.
+MODES = ('reference', 'chained', 'generalized')
+GPA_ITERATIONS = 100
+GPA_TOLERANCE = 1e-6
+ALIGNMENT_VERSION = 1  # part of the rotations' stage keys: bump when the fit changes
+
+
+def procrustes_rotations(references, targets):
+    """
+    For each pair, the orthogonal R minimizing ||target @ R - reference|| over the anchor
+    rows, from one np.linalg.svd of the stacked d x d cross products. The products and the
+    SVD are computed in float64 (the spectrum of word2vec cross products is steep) and R is
+    returned in the dtype of the vectors.
+    """
+    dtype = np.result_type(*references, *targets)
+    cross = np.stack([target.astype(np.float64).T @ reference.astype(np.float64)
+                      for reference, target in zip(references, targets)])
+    U, _, Vt = np.linalg.svd(cross)
+    return (U @ Vt).astype(dtype)
+
+
+def common_words(vectors):
+    """Sorted words present in every KeyedVectors of {name: vectors}."""
+    words = None
+    for wv in vectors.values():
+        words = set(wv.index_to_key) if words is None else words & set(wv.index_to_key)
+    return sorted(words or [])
+
+
+def frequency_anchors(words, top):
+    """
+    The `top` words of `words` that are most frequent in every dynasty, ranked by their
+    lowest per-million frequency in Diachronic_character_frequencies.csv.
+    """
+    freq_df_path = ROOT.parent / 'Diachronic_sub-database' / 'Diachronic_data' / 'Diachronic_character_frequencies.csv'
+    freq_df = read_table(freq_df_path).set_index('Character')
+    lowest = freq_df.filter(like='PerMillion_').min(axis=1)
+    ranked = lowest.reindex(words).dropna().sort_values(ascending=False, kind='stable')
+    return sorted(ranked.index[:top])
+
+
+class EmbeddingAligner:
+    """
+    Rotations of several embedding spaces into a shared one.
+
+    :param vectors: {name: KeyedVectors}, in chain order for the chained mode
+    :param mode: One of MODES
+    :param reference: The space the others are rotated onto (default: the first one)
+    :param anchors: The words the rotations are fitted on (default: the words common to all)
+    :param sources: {name: file} identifying each space; rotations are kept in the stage
+                    cache under the configuration and the files they depend on
+    """
+
+    def __init__(self, vectors, mode='reference', reference=None, anchors=None, sources=None):
+        if mode not in MODES:
+            raise ValueError(f'unknown alignment mode {mode!r}, expected one of {MODES}')
+        self.vectors = vectors
+        self.names = list(vectors)
+        self.mode = mode
+        self.reference = reference or self.names[0]
+        self.anchors = sorted(anchors) if anchors is not None else common_words(vectors)
+        self.sources = sources
+        self._rotations = {}
+        anchor_digest = hashlib.blake2b(repr(self.anchors).encode('utf-8'), digest_size=4).hexdigest()
+        self._stage = f'rotation_{mode}_{self.reference}_{anchor_digest}'
+
+    def depends_on(self, name):
+        """The spaces the rotation of `name` is fitted on."""
+        if self.mode == 'reference':
+            return [self.reference, name]
+        if self.mode == 'chained':
+            i, r = self.names.index(name), self.names.index(self.reference)
+            return self.names[min(i, r):max(i, r) + 1]
+        return self.names
+
+    def key(self, name):
+        """Stage key of the rotation of `name`: the configuration and the spaces it depends on."""
+        spaces = [part for other in self.depends_on(name) for part in (other, self.sources[other])]
+        return stage_key(self.mode, self.reference, self.anchors, *spaces, ALIGNMENT_VERSION)
+
+    def rotations(self):
+        """
+        {name: rotation into the shared space}. Only the rotations missing from the cache are
+        fitted, together and against the cached rotations of the other spaces, which are kept.
+        """
+        missing = []
+        for name in self.names:
+            if name in self._rotations:
+                continue
+            cached = load_result(f'{self._stage}_{name}', self.key(name)) if self.sources else None
+            if cached is None:
+                missing.append(name)
+            else:
+                self._rotations[name] = cached
+        if missing:
+            fitted = self._fit(missing)
+            for name in missing:
+                self._rotations[name] = fitted[name]
+                if self.sources:
+                    save_result(f'{self._stage}_{name}', self.key(name), fitted[name])
+        return {name: self._rotations[name] for name in self.names}
+
+    def rotation(self, name):
+        return self.rotations()[name]
+
+    def align(self, words):
+        """{name: matrix of `words` in the shared space}"""
+        return {name: np.asarray(self.vectors[name][words]) @ R for name, R in self.rotations().items()}
+
+    def _fit(self, missing):
+        """Rotations of the `missing` spaces, the others keeping the rotations in self._rotations."""
+        X = {name: np.asarray(self.vectors[name][self.anchors]) for name in self.names}
+        identity = np.eye(X[self.reference].shape[1], dtype=X[self.reference].dtype)
+        rotations = {self.reference: identity} if self.reference in missing else {}
+
+        if self.mode == 'reference':
+            others = [name for name in missing if name != self.reference]
+            if others:
+                fitted = procrustes_rotations([X[self.reference]] * len(others), [X[name] for name in others])
+                rotations.update(zip(others, fitted))
+            return rotations
+
+        if self.mode == 'chained':
+            # each space onto its neighbor towards the reference, in one batch, then composed
+            # outwards from the reference, so a neighbor's rotation is known before it is needed
+            r = self.names.index(self.reference)
+            pairs = ([(self.names[i - 1], self.names[i]) for i in range(r + 1, len(self.names))]
+                     + [(self.names[i + 1], self.names[i]) for i in range(r - 1, -1, -1)])
+            pairs = [(a, b) for a, b in pairs if b in missing]
+            if pairs:
+                fitted = procrustes_rotations([X[a] for a, _ in pairs], [X[b] for _, b in pairs])
+                for (a, b), R in zip(pairs, fitted):
+                    rotations[b] = R @ rotations.get(a, self._rotations.get(a))
+            return rotations
+
+        # generalized Procrustes, starting from the reference space or from the mean of the
+        # spaces whose rotations are kept
+        kept = {name: X[name] @ self._rotations[name] for name in self.names if name not in missing}
+        mean = np.mean(list(kept.values()), axis=0) if kept else X[self.reference]
+        for _ in range(GPA_ITERATIONS):
+            fitted = procrustes_rotations([mean] * len(missing), [X[name] for name in missing])
+            aligned = {**kept, **{name: X[name] @ R for name, R in zip(missing, fitted)}}
+            new_mean = np.mean([aligned[name] for name in self.names], axis=0)
+            settled = np.linalg.norm(new_mean - mean) <= GPA_TOLERANCE * np.linalg.norm(mean)
+            mean = new_mean
+            if settled:
+                break
+        return dict(zip(missing, fitted))
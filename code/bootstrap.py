@@ -0,0 +1,162 @@
+import argparse
+import math
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+from scipy.stats import rankdata
+from config import *
+from alignment import EmbeddingAligner, procrustes_rotations
+from embedding_alignment import load_aligned_embeddings, aligned_embeddings, alignment_record, ALIGNED_DIR
+from time_series_builder import normalize_rows, dynasty_similarities
+from stage_cache import stage_key, is_fresh, mark_done
+from table_io import write_table
+
+# Uncertainty of the diachronic cosine similarities. Every bootstrap replicate redraws the
+# anchor characters of the Procrustes fit with replacement, aligns every dynasty again in the
+# mode of the saved alignment (alignment.json) and recomputes the similarity of all characters
+# at once, so the intervals come from the same construction as the point estimate. The
+# replicates start from the saved aligned matrices: they are already in one space, and a
+# rotation fitted on them composes with the saved one to the rotation fitted on the raw model
+# vectors, so no model is loaded. Replicates are split over a process pool and every worker
+# writes its rows into one memory-mapped .npy of shape replicates x dynasty pairs x characters.
+BOOTSTRAP_DIR = OUTPUT / 'bootstrap'
+BATCH = 8  # replicates whose rotations share one batched SVD
+BOOTSTRAP_VERSION = 2  # part of the stage key: bump when the replicates are computed differently
+
+
+def bootstrap_shard(path, space, mode, reference, others, anchors, seeds, start):
+    """
+    Fill the rows [start, start + len(seeds)) of the replicate file at `path`: the similarities
+    of `others` with `reference`.
+    :param space: The dynasties of the saved alignment, its reference first
+    :param mode: The mode of the saved alignment (see alignment.MODES)
+    """
+    aligned, _ = load_aligned_embeddings(space)
+    normalized = {dy: normalize_rows(np.asarray(aligned[dy], dtype=np.float32)) for dy in space}
+    X = {dy: np.asarray(aligned[dy][anchors], dtype=np.float32) for dy in space}
+    refitted = space[1:]
+
+    out = np.load(path, mmap_mode='r+')
+    for batch in range(0, len(seeds), BATCH):
+        weights = []
+        for seed in seeds[batch:batch + BATCH]:
+            draws = np.random.default_rng(seed).integers(0, len(anchors), len(anchors))
+            weights.append(np.bincount(draws, minlength=len(anchors)))
+        if mode == 'reference':
+            # a resampled anchor counts as often as it was drawn: target.T @ reference is weighted
+            w = [weight.astype(np.float32)[:, None] for weight in weights]
+            fitted = procrustes_rotations([X[space[0]] for _ in w for _ in refitted],
+                                          [X[dy] * wi for wi in w for dy in refitted])
+            fitted = fitted.reshape(len(w), len(refitted), *fitted.shape[1:])
+            identity = np.eye(fitted.shape[-1], dtype=fitted.dtype)
+            replicates = [{space[0]: identity, **dict(zip(refitted, rotations))} for rotations in fitted]
+        else:
+            # the chained and generalized fits, on the anchor rows repeated as often as drawn
+            replicates = [EmbeddingAligner(X, mode, space[0], np.repeat(np.arange(len(anchors)), weight)).rotations()
+                          for weight in weights]
+        for i, rotations in enumerate(replicates):
+            base = normalized[reference] @ rotations[reference]
+            out[start + batch + i] = [np.einsum('ij,ij->i', normalized[dy] @ rotations[dy], base) for dy in others]
+    out.flush()
+    return len(seeds)
+
+
+def bootstrap_similarities(replicates=1000, jobs=1, reference=DYNASTIES[0], anchors=None, seed=200,
+                           dynasties=tuple(DYNASTIES)):
+    """
+    Bootstrap replicates of the cosine similarity of every common character between the
+    reference and each other dynasty.
+    :param anchors: The characters resampled for the rotations (default: all common characters)
+    :return: (memory-mapped replicates x pairs x characters array, pair names, common vocabulary)
+    """
+    if reference not in dynasties:
+        raise ValueError(f'unknown reference {reference!r}, expected one of {list(dynasties)}')
+    aligned, common_vocab = aligned_embeddings(dynasties)
+    record = alignment_record()
+    space, mode = record['dynasties'], record['mode']
+    others = [dy for dy in dynasties if dy != reference]
+    pairs = [f'{reference}&{dy}' for dy in others]
+    index = {char: i for i, char in enumerate(common_vocab)}
+    anchor_ids = np.arange(len(common_vocab)) if anchors is None else np.array(
+        sorted(index[char] for char in anchors if char in index), dtype=np.int64)
+
+    BOOTSTRAP_DIR.mkdir(parents=True, exist_ok=True)
+    path = BOOTSTRAP_DIR / f'similarities_{reference}.npy'
+    key = stage_key(replicates, seed, list(dynasties), space, mode, reference, anchor_ids.tolist(),
+                    BOOTSTRAP_VERSION, ALIGNED_DIR / 'vocab.npy', *[ALIGNED_DIR / f'{dy}_aligned.npy' for dy in space])
+    if is_fresh(f'bootstrap_{reference}', key, [path]):
+        return np.load(path, mmap_mode='r'), pairs, common_vocab
+
+    # one seed per replicate, so the replicates do not depend on how they are split
+    seeds = np.random.SeedSequence(seed).spawn(replicates)
+    open_memmap(path, mode='w+', dtype=np.float32, shape=(replicates, len(pairs), len(common_vocab))).flush()
+    print(f'Bootstrapping {replicates} replicates of {", ".join(pairs)}')
+    if jobs <= 1:
+        bootstrap_shard(path, space, mode, reference, others, anchor_ids, seeds, 0)
+    else:
+        shard = max(1, math.ceil(replicates / (jobs * 4)))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(bootstrap_shard, path, space, mode, reference, others, anchor_ids,
+                                       seeds[start:start + shard], start)
+                       for start in range(0, replicates, shard)]
+            for future in futures:
+                future.result()
+    mark_done(f'bootstrap_{reference}', key)
+    return np.load(path, mmap_mode='r'), pairs, common_vocab
+
+
+def similarity_intervals(replicates=1000, jobs=1, reference=DYNASTIES[0], anchors=None, confidence=0.95, seed=200):
+    """
+    Percentile confidence interval of every character's similarity with the reference, next to
+    the point estimate of Diachronic_character_similarities.csv. Saved to time_series.
+    """
+    dynasties = DYNASTIES
+    samples, pairs, common_vocab = bootstrap_similarities(replicates, jobs, reference, anchors, seed, dynasties)
+    aligned, _ = load_aligned_embeddings(dynasties)
+    estimates = dynasty_similarities(aligned, reference)
+
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(samples, [alpha, 1 - alpha], axis=0)
+    columns = {'Character': common_vocab}
+    for p, pair in enumerate(pairs):
+        columns[pair] = estimates[pair]
+        columns[f'{pair}_low'] = low[p]
+        columns[f'{pair}_high'] = high[p]
+        columns[f'{pair}_std'] = samples[:, p].std(axis=0)
+    df = pd.DataFrame(columns)
+
+    name = 'Diachronic_character_similarity_intervals'
+    if reference != dynasties[0]:
+        name += f'_{reference}'
+    save_path = ROOT.parent / 'Diachronic_sub-database' / 'time_series' / f'{name}.csv'
+    write_table(df, save_path, index=False)
+    print(f"Similarity intervals ({replicates} replicates) have been saved to '{name}.csv'.")
+    return df
+
+
+def spearman_permutation(x, y, permutations=10000, seed=200):
+    """
+    Spearman correlation of x and y with a two-sided permutation p-value: y is shuffled
+    `permutations` times and all shuffles are correlated in one matrix product.
+    """
+    rx, ry = rankdata(x), rankdata(y)
+    rx = (rx - rx.mean()) / np.linalg.norm(rx - rx.mean())
+    ry = (ry - ry.mean()) / np.linalg.norm(ry - ry.mean())
+    correlation = rx @ ry
+    rng = np.random.default_rng(seed)
+    shuffled = rng.permuted(np.broadcast_to(ry, (permutations, len(ry))), axis=1)
+    null = shuffled @ rx
+    p_value = (1 + np.count_nonzero(np.abs(null) >= abs(correlation) - 1e-12)) / (permutations + 1)
+    return correlation, p_value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replicates', type=int, default=1000, help='bootstrap replicates')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes sharing the replicates')
+    parser.add_argument('--reference', default=DYNASTIES[0], help='dynasty the others are compared with')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level of the intervals')
+    parser.add_argument('--seed', type=int, default=200)
+    args = parser.parse_args()
+    similarity_intervals(args.replicates, args.jobs, args.reference, confidence=args.confidence, seed=args.seed)
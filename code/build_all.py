@@ -0,0 +1,46 @@
+from config import *
+import argparse
+from corpus_scanner import scan_dynasties, encode_corpora, CACHED_KINDS
+from CAPLD_data_builder import generate_capld
+from Diachronic_data_builder import *
+from time_series_builder import *
+from lexicon_store import build_lexicon_store
+
+
+def build_all(jobs=1, workers=WORD2VEC_WORKERS, incremental=False, export_csv=False):
+    # One pass over each dynasty corpus feeds every counting stage below; the stages only aggregate.
+    # The counts go to the stage cache as each corpus is scanned, and every stage reads them back
+    # one period at a time, so the matrices of all periods are never held together.
+    # Word2Vec streams its sentences from the encoded corpora into a LineSentence file per model.
+    # Counters and models of unchanged dynasties come from the stage cache instead.
+    # The corpora are encoded once into token arrays that the scans read without parsing text.
+    encode_corpora()
+    scan_dynasties(DYNASTIES, CACHED_KINDS, jobs)
+
+    generate_capld()
+    generate_dynasty_char_vocab()
+    generate_diachronic_diversity()
+    generate_diachronic_character_phonology()
+    generate_diachronic_rhyme_positions()
+    generate_co_occurrence_matrix(export_csv)
+
+    train_dynasty_word2vec(jobs, workers, incremental)
+    align_embedding_space()
+
+    generate_Entropy()
+    generate_frequency_diversity()
+    generate_dynasty_cosine_similarity()
+
+    build_lexicon_store()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for the corpus scans and model training')
+    parser.add_argument('--workers', type=int, default=WORD2VEC_WORKERS, help='Word2Vec threads, shared by the parallel models')
+    parser.add_argument('--incremental', action='store_true',
+                        help='update the models of dynasties that only gained new source files instead of retraining them')
+    parser.add_argument('--export-csv', action='store_true',
+                        help='also write the dense co-occurrence CSVs of earlier releases')
+    args = parser.parse_args()
+    build_all(args.jobs, args.workers, args.incremental, args.export_csv)
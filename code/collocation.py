@@ -0,0 +1,140 @@
+import argparse
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import svds
+from gensim.models import KeyedVectors
+from config import *
+from corpus_scanner import scan_dynasty, scan_dynasties, period_paths, WindowAccumulator, TrigramAccumulator
+from embedding_alignment import EMBEDDING_DIR
+from stage_cache import stage_key, is_fresh, mark_done
+from table_io import read_table, write_table
+
+# Collocation statistics per period, from the corpus scanner's 'window{k}' (±k characters
+# within a line) and 'trigram' counts: every window size asked for is counted in the same
+# pass over each slice, the periods merged from the cached slice counts. Matrices are over the characters with Frequency > 10,
+# as the bigram co-occurrence matrices, and saved as scipy.sparse .npz with their vocabulary.
+COLLOCATION_DIR = ROOT.parent / 'Diachronic_sub-database' / 'collocation_matrices'
+COLLOCATION_VERSION = 2  # part of the stage key: bump when the matrices are derived differently
+
+
+def top_k_per_row(matrix, k):
+    """The k largest entries of every row of a sparse matrix (ties broken by column)."""
+    matrix = sparse.csr_matrix(matrix)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    order = np.lexsort((-matrix.data, rows))
+    rank = np.arange(len(order)) - matrix.indptr[rows[order]]
+    keep = order[rank < k]
+    return sparse.csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
+
+
+def pmi(counts, alpha=0.75, positive=True, top_k=None):
+    """
+    Pointwise mutual information of the observed pairs of a co-occurrence matrix,
+    log(p(i, j) / (p(i) p_alpha(j))), with the context distribution smoothed by alpha.
+    :param positive: PPMI: negative values are set to 0 and dropped
+    :param top_k: keep only the k highest values of each row
+    """
+    counts = sparse.csr_matrix(counts, dtype=np.float64, copy=True)  # its index arrays are modified below
+    counts.eliminate_zeros()
+    row_totals = np.asarray(counts.sum(axis=1)).ravel()
+    contexts = np.asarray(counts.sum(axis=0)).ravel() ** alpha
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    values = np.log(counts.data * contexts.sum() / (row_totals[rows] * contexts[counts.indices]))
+    if positive:
+        values = np.maximum(values, 0)
+    counts.data = values
+    counts.eliminate_zeros()
+    return top_k_per_row(counts, top_k) if top_k else counts
+
+
+def ppmi_svd(ppmi, dim=300, eig=0.5):
+    """
+    Embeddings from the truncated SVD of a PPMI matrix, U * S ** eig, with the largest
+    component of every dimension made positive so the result does not depend on the solver.
+    svds needs fewer components than the smaller side of the matrix, so a matrix with a single
+    row or column is decomposed densely (one dimension) and an empty one has no dimensions.
+    """
+    if min(ppmi.shape) == 0:
+        return np.zeros((ppmi.shape[0], 0), dtype=np.float32)
+    if min(ppmi.shape) == 1:
+        U, S, _ = np.linalg.svd(sparse.csr_matrix(ppmi, dtype=np.float64).toarray(), full_matrices=False)
+        dim = min(dim, 1)
+        U, S = U[:, :dim], S[:dim]
+    else:
+        dim = min(dim, min(ppmi.shape) - 1)
+        U, S, _ = svds(sparse.csr_matrix(ppmi, dtype=np.float64), k=dim, v0=np.ones(min(ppmi.shape)))
+        order = np.argsort(-S)
+        U, S = U[:, order], S[order]
+    signs = np.sign(U[np.abs(U).argmax(axis=0), np.arange(dim)])
+    signs = np.where(signs == 0, 1, signs)  # an all-zero component keeps its sign
+    return (U * signs * S ** eig).astype(np.float32)
+
+
+def generate_collocations(windows=(5,), jobs=1, alpha=0.75, top_k=None, dim=None, min_count=5):
+    """
+    Save per period and window size k the ±k co-occurrence counts, their PPMI matrix and the
+    trigrams seen at least min_count times; with dim, also PPMI-SVD embeddings
+    ({dy}_ppmi{k}_svd.kv in Dynasty_embeddings/), a baseline next to the Word2Vec models.
+    :param windows: The window sizes, all counted in one scan of each slice
+    """
+    dynasties = DYNASTIES
+    windows = [windows] if isinstance(windows, int) else list(windows)
+    COLLOCATION_DIR.mkdir(parents=True, exist_ok=True)
+    stale = {}
+    for dy in dynasties:
+        for window in windows:
+            key = stage_key(*period_paths(dy), OUTPUT / f'Char_vocab_{dy}.csv', window, alpha, top_k, dim, min_count,
+                            WindowAccumulator.version, TrigramAccumulator.version, COLLOCATION_VERSION)
+            outputs = [COLLOCATION_DIR / f'{kind}{window}_{dy}.npz' for kind in ('window', 'ppmi')] + \
+                      [COLLOCATION_DIR / f'collocation_{dy}_vocab.csv', COLLOCATION_DIR / f'trigrams_{dy}.csv'] + \
+                      ([EMBEDDING_DIR / f'{dy}_ppmi{window}_svd.kv'] if dim else [])
+            if not is_fresh(f'collocation{window}_{dy}', key, outputs):
+                stale.setdefault(dy, {})[window] = key
+    scan_dynasties(list(stale), sorted({f'window{window}' for todo in stale.values() for window in todo})
+                   + ['trigram'], jobs)
+
+    for dy, todo in stale.items():
+        print(dy + ' is processing')
+        vocab_df = read_table(OUTPUT / f'Char_vocab_{dy}.csv')
+        filtered_vocab_df = vocab_df[vocab_df['Frequency'] > 10]
+        characters = filtered_vocab_df['Character'].tolist()
+        write_table(filtered_vocab_df, COLLOCATION_DIR / f'collocation_{dy}_vocab.csv', index=False)
+        trigrams = pd.DataFrame(scan_dynasty(dy, ['trigram'])['trigram'].most_common(min_count=min_count),
+                                columns=['Trigram', 'Count'])
+        write_table(trigrams, COLLOCATION_DIR / f'trigrams_{dy}.csv', index=False)
+
+        for window, key in todo.items():
+            counts = scan_dynasty(dy, [f'window{window}'])[f'window{window}'].submatrix(characters)
+            ppmi = pmi(counts, alpha, top_k=top_k)
+            sparse.save_npz(COLLOCATION_DIR / f'window{window}_{dy}.npz', counts)
+            sparse.save_npz(COLLOCATION_DIR / f'ppmi{window}_{dy}.npz', ppmi)
+
+            if dim:
+                embeddings = ppmi_svd(ppmi, dim)
+                vectors = KeyedVectors(embeddings.shape[1])
+                vectors.add_vectors(characters, embeddings)
+                vectors.save(str(EMBEDDING_DIR / f'{dy}_ppmi{window}_svd.kv'))
+            mark_done(f'collocation{window}_{dy}', key)
+        print(dy + ' now has been saved to ' + str(COLLOCATION_DIR))
+
+
+def load_collocations(dy, window=5, kind='ppmi'):
+    """
+    :param kind: 'ppmi' or 'window' (the raw counts)
+    :return: The sparse matrix of a period and its characters, in row order
+    """
+    characters = read_table(COLLOCATION_DIR / f'collocation_{dy}_vocab.csv', ['Character'])['Character'].tolist()
+    return sparse.load_npz(COLLOCATION_DIR / f'{kind}{window}_{dy}.npz'), characters
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--window', type=int, nargs='+', default=[5], help='window sizes k (±k characters within a line)')
+    parser.add_argument('--jobs', type=int, default=1, help='worker processes for the corpus scans')
+    parser.add_argument('--alpha', type=float, default=0.75, help='context distribution smoothing of the PMI')
+    parser.add_argument('--top-k', type=int, default=None, help='keep the k strongest PPMI entries of each row')
+    parser.add_argument('--dim', type=int, default=None, help='also derive PPMI-SVD embeddings of this size')
+    parser.add_argument('--min-count', type=int, default=5, help='trigrams seen fewer times are not listed')
+    args = parser.parse_args()
+    generate_collocations(args.window, args.jobs, args.alpha, args.top_k, args.dim, args.min_count)
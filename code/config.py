@@ -7,5 +7,37 @@ SOURCE = ROOT / 'source'
 CORPUS = SOURCE / 'corpus'
 OUTPUT = ROOT / 'output'
 
+# Corpus slices, in time order. Each slice corpus is merged from the raw files whose name
+# starts with one of its `files` characters (utils.get_dynasty_corpus) and is scanned once.
+# A slice may keep only the poems of the authors listed in a text file (one name per line);
+# the poems of a raw file go to the first slice that accepts them, so e.g.
+#     'High_Tang': {'files': '唐', 'authors': SOURCE / 'periods' / 'high_tang.txt'},
+#     'Late_Tang': {'files': '唐'},
+# split the Tang poems into the listed poets and the rest.
+SLICES = {
+    'Tang': {'files': '唐'},
+    'Song': {'files': '宋辽金'},  # Liao and Jin are counted with Song
+    'Yuan': {'files': '元'},
+    'Ming': {'files': '明'},
+    'Qing': {'files': '清'},
+}
+
+# The periods the builders and time series report on, in time order, each the union of its
+# slices. Their counts are merged from the cached per-slice scans; the first period is the
+# reference of the time series.
+PERIODS = {name: [name] for name in SLICES}
+
+# Sliding windows over the slices, appended to PERIODS: (size, step) adds every run of `size`
+# consecutive slices, `step` apart, named after its first and last slice ('Tang-Song', ...).
+WINDOW = None
+
+if WINDOW:
+    _size, _step = WINDOW
+    _names = list(SLICES)
+    PERIODS.update({f'{_names[i]}-{_names[i + _size - 1]}': _names[i:i + _size]
+                    for i in range(0, len(_names) - _size + 1, _step)})
+
+DYNASTIES = list(PERIODS)
+
 
 OUTPUT.mkdir(exist_ok=True)
\ No newline at end of file
@@ -0,0 +1,985 @@
+import re
+import string
+import hashlib
+import json
+import math
+from concurrent.futures import ProcessPoolExecutor
+from collections import Counter
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from config import *
+from stage_cache import stage_key, has_result, load_result, save_result, cached, is_fresh, mark_done
+from table_io import iter_column, source_path, row_group_starts, csv_row_offsets, csv_byte_range
+
+# Cleaning patterns used by the builders. Each accumulator asks the chunk for the
+# variant it needs, so a pattern is applied at most once per poem.
+NON_CHINESE = re.compile(r'[^\u4e00-\u9fa5]')
+NON_CJK = re.compile(r'[^\u4e00-\u9fff]')
+WORD2VEC_NOISE = re.compile(r'[a-zA-Z,.?()（）【】\[\]!，\'" ]+')
+SENTENCE_SPLIT = re.compile('。|？|！|，')
+PUNCTUATION_AND_SPACE = set(string.punctuation + ' ' + '，。！？；：（）【】《》“”‘’——……')
+PUNCTUATION_CODES = np.array(sorted(ord(char) for char in PUNCTUATION_AND_SPACE))
+SENTENCE_CODES = np.array([ord(char) for char in '。？！'])  # ， is WORD2VEC_NOISE, removed before the split
+LINE_BREAK_CODES = np.union1d(PUNCTUATION_CODES, [ord(char) for char in '、·「」『』〈〉〔〕\n\r\t\u3000'])
+
+CHUNKSIZE = 20000
+MANIFEST_NAME = 'manifest.json'
+CODE_SPACE = 0x110000  # every Unicode code point
+CHINESE_FIRST, CHINESE_LAST = 0x4e00, 0x9fa5
+CHINESE_SPACE = CHINESE_LAST - CHINESE_FIRST + 1
+
+
+def is_chinese(char):
+    return '\u4e00' <= char <= '\u9fa5'
+
+
+def encode_texts(texts):
+    """
+    Concatenate texts into one array of code points.
+    :return: (codes, offsets), poem i being codes[offsets[i]:offsets[i + 1]]
+    """
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, texts), dtype=np.int64, count=len(texts)), out=offsets[1:])
+    codes = np.frombuffer(''.join(texts).encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+    return codes, offsets
+
+
+def poem_counts(codes, offsets):
+    """Number of poems each code point occurs in: unique (poem, character) pairs, then one bincount."""
+    poem_ids = np.repeat(np.arange(len(offsets) - 1, dtype=np.int64), np.diff(offsets))
+    pairs = np.unique((poem_ids << 21) | codes)
+    return np.bincount(pairs & 0x1FFFFF, minlength=CODE_SPACE)
+
+
+def content_hashes(texts):
+    """64-bit content hash of each text, used to recognise duplicate poems without keeping them."""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'little')
+         for text in texts), dtype=np.uint64, count=len(texts))
+
+
+def pattern_mask(pattern, codes):
+    """
+    Which code points a cleaning pattern deletes. The patterns above are classes of single
+    characters, so sub('', text) is the same as dropping every character the class matches;
+    the regex is run once per distinct code point.
+    """
+    distinct, inverse = np.unique(codes, return_inverse=True)
+    matched = np.array([pattern.fullmatch(chr(code)) is not None for code in distinct], dtype=bool)
+    return matched[inverse.reshape(-1)]
+
+
+def sentence_spans(codes, offsets):
+    """
+    (start, end) in `codes` of every Word2Vec sentence: the pieces of each poem between
+    。？！ that keep at least one character once WORD2VEC_NOISE is removed.
+    """
+    cuts = np.flatnonzero(np.isin(codes, SENTENCE_CODES))
+    starts = np.sort(np.concatenate([offsets[:-1], cuts + 1]))
+    ends = np.sort(np.concatenate([offsets[1:], cuts]))
+    kept = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum(~pattern_mask(WORD2VEC_NOISE, codes), out=kept[1:])
+    spans = np.stack([starts, ends], axis=1)
+    return spans[kept[ends] > kept[starts]]
+
+
+def line_spans(codes, offsets):
+    """
+    The lines of the poems: the runs of characters between punctuation marks or spaces
+    (LINE_BREAK_CODES), never spanning two poems, that hold a Chinese character. Any other
+    character, such as the □ of an illegible one or a CJK extension character, stays in its
+    line and takes up its position there. Lines come in couplets, lines 2i and 2i + 1 of a
+    poem, the second line of a couplet ending on the rhyme.
+    :return: ((start, end) in `codes` of every line, its number within its poem)
+    """
+    inside = ~np.isin(codes, LINE_BREAK_CODES)
+    starts = inside.copy()
+    starts[1:] &= ~inside[:-1]
+    first = offsets[:-1][offsets[:-1] < len(codes)]
+    starts[first] = inside[first]  # a poem starts a new line
+    ends = inside.copy()
+    ends[:-1] &= starts[1:] | ~inside[1:]
+    spans = np.stack([np.flatnonzero(starts), np.flatnonzero(ends) + 1], axis=1)
+    chinese = np.zeros(len(codes) + 1, dtype=np.int64)
+    np.cumsum((codes >= CHINESE_FIRST) & (codes <= CHINESE_LAST), out=chinese[1:])
+    spans = spans[chinese[spans[:, 1]] > chinese[spans[:, 0]]]
+    poem_first_line = np.searchsorted(spans[:, 0], offsets[:-1])
+    poems = np.searchsorted(offsets, spans[:, 0], side='right') - 1
+    return spans, np.arange(len(spans)) - poem_first_line[poems]
+
+
+def chinese_ids(chars):
+    """Row/column index of each character in the CHINESE_SPACE matrices."""
+    return np.array([ord(char) - CHINESE_FIRST for char in chars], dtype=np.int64)
+
+
+def code_ids(codes):
+    """chinese_ids of code points, and which of them are Chinese characters (the others are out of range)."""
+    ids = codes.astype(np.int64) - CHINESE_FIRST
+    return ids, (ids >= 0) & (ids < CHINESE_SPACE)
+
+
+class Chunk:
+    """
+    A block of poems from the `内容` column, with cleaned variants cached by pattern.
+    Chunks of an encoded corpus (Chunk.from_tokens) hold token ids instead of strings;
+    their cleaned code points are computed with numpy and texts are only decoded when an
+    accumulator asks for them.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.corpus = self.tokens = self.offsets = self.spans = None
+        self._lines = None
+        self._cleaned = {}
+        self._encoded = {}
+
+    @classmethod
+    def from_tokens(cls, corpus, tokens, offsets, spans, lines=None):
+        chunk = cls(None)
+        chunk.corpus, chunk.tokens, chunk.offsets, chunk.spans = corpus, tokens, offsets, spans
+        chunk._lines = lines
+        return chunk
+
+    def lines(self):
+        """(start, end) of every line in the raw codes and its number within its poem (see line_spans)."""
+        if self._lines is None:
+            self._lines = line_spans(*self.encoded())
+        return self._lines
+
+    def line_ids(self):
+        """Line of every raw code point, -1 outside the lines."""
+        spans, _ = self.lines()
+        ids = np.full(len(self.encoded()[0]), -1, dtype=np.int64)
+        lengths = spans[:, 1] - spans[:, 0]
+        positions = np.repeat(spans[:, 0] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        ids[positions] = np.repeat(np.arange(len(spans)), lengths)
+        return ids
+
+    def texts(self, pattern=None):
+        if self.raw is None:
+            self.raw = self._decode(*self.encoded())
+        if pattern is None:
+            return self.raw
+        if pattern not in self._cleaned:
+            if self.tokens is not None:
+                self._cleaned[pattern] = self._decode(*self.encoded(pattern))
+            else:
+                self._cleaned[pattern] = [pattern.sub('', text) for text in self.raw]
+        return self._cleaned[pattern]
+
+    def encoded(self, pattern=None):
+        if pattern not in self._encoded:
+            if self.tokens is not None:
+                self._encoded[pattern] = self._clean_tokens(pattern)[:2]
+            else:
+                self._encoded[pattern] = encode_texts(self.texts(pattern))
+        return self._encoded[pattern]
+
+    def sentences(self):
+        """Character lists of the Word2Vec sentences, as SENTENCE_SPLIT over the WORD2VEC_NOISE-cleaned texts."""
+        if self.tokens is None:
+            return [list(s) for text in self.texts(WORD2VEC_NOISE) for s in SENTENCE_SPLIT.split(text) if s]
+        codes, _, kept = self._clean_tokens(WORD2VEC_NOISE)
+        text = codes.tobytes().decode('utf-32-le', 'surrogatepass')
+        return [list(text[start:end]) for start, end in kept[self.spans].tolist()]
+
+    def _clean_tokens(self, pattern):
+        # kept[i]: number of characters left before raw position i, mapping raw offsets to cleaned ones
+        codes = self.corpus.vocab[self.tokens]
+        if pattern is None:
+            return codes, self.offsets, None
+        keep = ~self.corpus.deleted(pattern)[self.tokens]
+        kept = np.zeros(len(keep) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        return codes[keep], kept[self.offsets], kept
+
+    @staticmethod
+    def _decode(codes, offsets):
+        text = codes.tobytes().decode('utf-32-le', 'surrogatepass')
+        return [text[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+class FrequencyAccumulator:
+    """
+    Character frequencies over the cleaned text (Char_vocab_{dy}.csv, CAPLD Frequency).
+    Counts are kept per code point together with the position of the first occurrence,
+    so `counts` lists characters in the order a Counter fed poem by poem would, and
+    most_common() breaks ties the same way.
+    """
+
+    version = 2
+
+    def __init__(self, pattern=NON_CHINESE):
+        self.pattern = pattern
+        self.frequencies = np.zeros(CODE_SPACE, dtype=np.int64)
+        self.first = np.full(CODE_SPACE, np.iinfo(np.int64).max, dtype=np.int64)
+        self.length = 0
+
+    def update(self, chunk):
+        codes, _ = chunk.encoded(self.pattern)
+        distinct, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        self.frequencies[distinct] += counts
+        np.minimum.at(self.first, distinct, first + self.length)
+        self.length += len(codes)
+
+    def merge(self, other):
+        seen = np.flatnonzero(other.frequencies)
+        self.frequencies[seen] += other.frequencies[seen]
+        np.minimum.at(self.first, seen, other.first[seen] + self.length)
+        self.length += other.length
+
+    @property
+    def counts(self):
+        seen = np.flatnonzero(self.frequencies)
+        seen = seen[np.argsort(self.first[seen], kind='stable')]
+        return Counter(dict(zip(map(chr, seen.tolist()), self.frequencies[seen].tolist())))
+
+
+class DiversityAccumulator:
+    """Number of poems each character occurs in."""
+
+    version = 1
+
+    def __init__(self):
+        self.poems = np.zeros(CODE_SPACE, dtype=np.int64)
+
+    def update(self, chunk):
+        self.poems += poem_counts(*chunk.encoded())
+
+    def merge(self, other):
+        self.poems += other.poems
+
+    def count(self, chars):
+        return self.poems[[ord(char) for char in chars]]
+
+
+class ContentDiversityAccumulator:
+    """
+    Number of distinct poem contents each character occurs in (CAPLD CD). Kind 'content_diversity'.
+    Duplicates are recognised by content hash. Besides the per-character counts, memory is
+    8 bytes per distinct poem and 4 per distinct character of it: merge needs the characters
+    of the poems both accumulators counted, to count them once.
+    """
+
+    version = 1
+
+    def __init__(self, pattern=NON_CJK):
+        self.pattern = pattern
+        self.poems = np.zeros(CODE_SPACE, dtype=np.int64)
+        self.seen = np.zeros(0, dtype=np.uint64)
+        # per distinct poem, in the order counted: its hash, its distinct characters and their number
+        self._parts = [(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64))]
+
+    def update(self, chunk):
+        hashes = content_hashes(chunk.texts())
+        _, first = np.unique(hashes, return_index=True)
+        first = np.sort(first[~np.isin(hashes[first], self.seen, assume_unique=True)])
+        self.seen = np.union1d(self.seen, hashes[first])
+        texts = chunk.texts(self.pattern)
+        codes, offsets = encode_texts([texts[i] for i in first])
+        poem_ids = np.repeat(np.arange(len(first), dtype=np.int64), np.diff(offsets))
+        pairs = np.unique((poem_ids << 21) | codes)  # as poem_counts
+        chars = (pairs & 0x1FFFFF).astype(np.uint32)
+        self.poems += np.bincount(chars, minlength=CODE_SPACE)
+        self._parts.append((hashes[first], chars, np.bincount(pairs >> 21, minlength=len(first))))
+
+    def merge(self, other):
+        hashes, chars, lengths = other._poems()
+        shared = np.isin(hashes, self.seen)
+        counted = np.repeat(shared, lengths)
+        self.poems += other.poems - np.bincount(chars[counted], minlength=CODE_SPACE)
+        self.seen = np.union1d(self.seen, hashes)
+        self._parts.append((hashes[~shared], chars[~counted], lengths[~shared]))
+
+    def _poems(self):
+        if len(self._parts) > 1:
+            self._parts = [tuple(np.concatenate(arrays) for arrays in zip(*self._parts))]
+        return self._parts[0]
+
+    def __getstate__(self):
+        self._poems()
+        return self.__dict__
+
+    def count(self, chars):
+        return self.poems[[ord(char) for char in chars]]
+
+
+class BigramAccumulator:
+    """
+    Counts of adjacent Chinese character pairs in the raw text, as a sparse
+    CHINESE_SPACE x CHINESE_SPACE matrix indexed by chinese_ids.
+    """
+
+    version = 1
+
+    def __init__(self):
+        self.matrix = sparse.csr_matrix((CHINESE_SPACE, CHINESE_SPACE), dtype=np.int64)
+
+    def update(self, chunk):
+        codes, offsets = chunk.encoded()
+        first, second = codes[:-1].astype(np.int64), codes[1:].astype(np.int64)
+        keep = ((first >= CHINESE_FIRST) & (first <= CHINESE_LAST)
+                & (second >= CHINESE_FIRST) & (second <= CHINESE_LAST))
+        boundaries = offsets[1:-1]
+        keep[boundaries[(boundaries > 0) & (boundaries < len(codes))] - 1] = False  # pairs spanning two poems
+        first, second = first[keep] - CHINESE_FIRST, second[keep] - CHINESE_FIRST
+        counts = sparse.coo_matrix((np.ones(len(first), dtype=np.int64), (first, second)),
+                                   shape=(CHINESE_SPACE, CHINESE_SPACE))
+        self.matrix = self.matrix + counts.tocsr()
+
+    def merge(self, other):
+        self.matrix = self.matrix + other.matrix
+
+    def submatrix(self, chars):
+        ids = chinese_ids(chars)
+        return self.matrix[ids][:, ids]
+
+
+class NeighborAccumulator:
+    """
+    Left and right neighbor counts of each Chinese character, skipping punctuation, as
+    sparse CHINESE_SPACE x CODE_SPACE matrices (rows by chinese_ids, columns by code point).
+    The first and last character of a poem are not counted as centers.
+    """
+
+    version = 2
+
+    def __init__(self):
+        self.left = sparse.csr_matrix((CHINESE_SPACE, CODE_SPACE), dtype=np.int64)
+        self.right = sparse.csr_matrix((CHINESE_SPACE, CODE_SPACE), dtype=np.int64)
+
+    def update(self, chunk):
+        codes, offsets = chunk.encoded()
+        codes = codes.astype(np.int64)
+        lengths = np.diff(offsets)
+        position = np.arange(len(codes)) - np.repeat(offsets[:-1], lengths)
+        center = ((position >= 1) & (position <= np.repeat(lengths, lengths) - 2)
+                  & (codes >= CHINESE_FIRST) & (codes <= CHINESE_LAST))
+        center = np.flatnonzero(center)
+        counted = ~np.isin(codes, PUNCTUATION_CODES)
+        self.left = self.left + self._count(codes, center, center - 1, counted)
+        self.right = self.right + self._count(codes, center, center + 1, counted)
+
+    @staticmethod
+    def _count(codes, center, neighbor, counted):
+        keep = counted[neighbor]
+        rows, cols = codes[center[keep]] - CHINESE_FIRST, codes[neighbor[keep]]
+        return sparse.coo_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                 shape=(CHINESE_SPACE, CODE_SPACE)).tocsr()
+
+    def merge(self, other):
+        self.left = self.left + other.left
+        self.right = self.right + other.right
+
+
+class SentenceAccumulator:
+    """Character lists of each sentence, the training input of the dynasty Word2Vec models."""
+
+    version = 1
+
+    def __init__(self):
+        self.sentences = []
+
+    def update(self, chunk):
+        self.sentences.extend(chunk.sentences())
+
+    def merge(self, other):
+        self.sentences.extend(other.sentences)
+
+
+# Collocation counts (collocation.py) are kept within a line (see line_spans) and only count
+# Chinese characters, a character of any other kind still taking up its place. Their sparse tables are read capped at the
+# MAX_PAIRS largest entries. While a table holds at most HIGH_WATER entries its counts are
+# exact, so the capped table does not depend on the chunk size or the number of jobs. Past
+# HIGH_WATER the table is cut down to MAX_PAIRS entries as it grows; from then on its counts
+# are approximate (a pair dropped once starts again from zero, so counts are lower bounds
+# and which pairs survive depends on the order the chunks are counted in).
+MAX_PAIRS = 50_000_000
+HIGH_WATER = 2 * MAX_PAIRS
+BUFFERED = 1 << 22  # per-chunk counts held before they are folded into a table
+
+
+def prune(counts, cap):
+    """
+    Which counts to keep so that exactly `cap` are left (all when under it): the largest,
+    ties at the cap-th largest broken by rank, earlier entries (smaller keys) first.
+    """
+    if cap is None or len(counts) <= cap:
+        return np.ones(len(counts), dtype=bool)
+    if cap <= 0:
+        return np.zeros(len(counts), dtype=bool)
+    threshold = counts[np.argpartition(counts, len(counts) - cap)[len(counts) - cap]]
+    keep = counts > threshold
+    ties = np.flatnonzero(counts == threshold)
+    keep[ties[:cap - np.count_nonzero(keep)]] = True
+    return keep
+
+
+class WindowAccumulator:
+    """
+    Co-occurrence counts of Chinese characters at most `k` characters apart within a line,
+    in both directions (a symmetric ±k window), as a sparse CHINESE_SPACE x CHINESE_SPACE
+    matrix indexed by chinese_ids. Kind 'window{k}'. The pairs of each chunk are buffered
+    and added to the matrix once they are about as many as its entries, so the matrix is
+    not rebuilt for every chunk.
+    """
+
+    version = (3, MAX_PAIRS)
+
+    def __init__(self, k=2):
+        self.k = k
+        self.matrix = sparse.csr_matrix((CHINESE_SPACE, CHINESE_SPACE), dtype=np.int64)
+        self._pending, self._held = [], 0
+
+    def update(self, chunk):
+        codes, _ = chunk.encoded()
+        lines = chunk.line_ids()
+        ids, chinese = code_ids(codes)
+        # one distance at a time, so the pairs held at once are bounded by the chunk length
+        for d in range(1, self.k + 1):
+            keep = np.flatnonzero((lines[:-d] >= 0) & (lines[:-d] == lines[d:]) & chinese[:-d] & chinese[d:])
+            first, second = ids[keep], ids[keep + d]
+            self._add(np.concatenate([first, second]), np.concatenate([second, first]),
+                      np.ones(2 * len(keep), dtype=np.int64))
+
+    def merge(self, other):
+        other._consolidate()  # uncapped, so merged shards count as one serial scan
+        counts = other.matrix.tocoo()
+        self._add(counts.row, counts.col, counts.data)
+
+    def _add(self, rows, cols, counts):
+        self._pending.append((rows, cols, counts))
+        self._held += len(counts)
+        if self._held >= max(self.matrix.nnz, BUFFERED):
+            self._consolidate()
+
+    def _consolidate(self):
+        if not self._pending:
+            return
+        table = self.matrix.tocoo()
+        rows, cols, counts = ([table.row] + [part[0] for part in self._pending],
+                              [table.col] + [part[1] for part in self._pending],
+                              [table.data] + [part[2] for part in self._pending])
+        self.matrix = sparse.csr_matrix((np.concatenate(counts), (np.concatenate(rows), np.concatenate(cols))),
+                                        shape=(CHINESE_SPACE, CHINESE_SPACE), dtype=np.int64)
+        self.matrix.sum_duplicates()  # canonical: entries in (row, column) order
+        self._pending, self._held = [], 0
+        if self.matrix.nnz > HIGH_WATER:
+            self.matrix = _capped(self.matrix, MAX_PAIRS)
+
+    def table(self):
+        """The whole count matrix, capped at MAX_PAIRS entries."""
+        self._consolidate()
+        return _capped(self.matrix, MAX_PAIRS)
+
+    def submatrix(self, chars):
+        ids = chinese_ids(chars)
+        return self.table()[ids][:, ids]
+
+    def __getstate__(self):
+        self._consolidate()  # pickled (stage cache, pool results) without the buffer
+        return self.__dict__
+
+
+def _capped(matrix, cap):
+    """A canonical sparse matrix with only its `cap` largest entries (see prune)."""
+    if matrix.nnz <= cap:
+        return matrix
+    matrix = matrix.copy()
+    matrix.data[~prune(matrix.data, cap)] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+class TrigramAccumulator:
+    """
+    Counts of the character trigrams within a line, as sorted int64 keys (a, b, c in
+    chinese_ids: (a * CHINESE_SPACE + b) * CHINESE_SPACE + c) and their counts. As in
+    WindowAccumulator, the counts of each chunk are buffered and folded into the sorted
+    table once they are about as many as its entries.
+    """
+
+    version = (3, MAX_PAIRS)
+
+    def __init__(self):
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self._pending, self._held = [], 0
+
+    def update(self, chunk):
+        codes, _ = chunk.encoded()
+        lines = chunk.line_ids()
+        ids, chinese = code_ids(codes)
+        keep = np.flatnonzero((lines[:-2] >= 0) & (lines[:-2] == lines[2:])
+                              & chinese[:-2] & chinese[1:-1] & chinese[2:])
+        keys, counts = np.unique((ids[keep] * CHINESE_SPACE + ids[keep + 1]) * CHINESE_SPACE + ids[keep + 2],
+                                 return_counts=True)
+        self._add(keys, counts)
+
+    def merge(self, other):
+        other._consolidate()
+        self._add(other.keys, other.counts)
+
+    def _add(self, keys, counts):
+        self._pending.append((keys, counts))
+        self._held += len(keys)
+        if self._held >= max(len(self.keys), BUFFERED):
+            self._consolidate()
+
+    def _consolidate(self):
+        if not self._pending:
+            return
+        keys, inverse = np.unique(np.concatenate([self.keys] + [keys for keys, _ in self._pending]),
+                                  return_inverse=True)
+        counts = np.bincount(inverse.reshape(-1), minlength=len(keys),
+                             weights=np.concatenate([self.counts] + [counts for _, counts in self._pending]))
+        self.keys, self.counts = keys, counts.astype(np.int64)
+        self._pending, self._held = [], 0
+        if len(self.keys) > HIGH_WATER:
+            self.keys, self.counts = self.table()
+
+    def table(self):
+        """(keys, counts) of every trigram, capped at MAX_PAIRS entries."""
+        self._consolidate()
+        keep = prune(self.counts, MAX_PAIRS)
+        return self.keys[keep], self.counts[keep]
+
+    def __getstate__(self):
+        self._consolidate()
+        return self.__dict__
+
+    def most_common(self, n=None, min_count=1):
+        """[(trigram, count), ...], most frequent first."""
+        table_keys, table_counts = self.table()
+        order = np.argsort(-table_counts, kind='stable')
+        order = order[table_counts[order] >= min_count][:n]
+        keys = table_keys[order]
+        chars = np.stack([keys // CHINESE_SPACE ** 2, keys // CHINESE_SPACE % CHINESE_SPACE,
+                          keys % CHINESE_SPACE], axis=1) + CHINESE_FIRST
+        text = chars.astype(np.uint32).tobytes().decode('utf-32-le')
+        return [(text[3 * i:3 * i + 3], count) for i, count in enumerate(table_counts[order].tolist())]
+
+    def matrix(self, chars):
+        """
+        Trigram counts among `chars` as a sparse (len(chars) ** 2) x len(chars) matrix:
+        row i * len(chars) + j holds the counts of the characters following chars[i] chars[j].
+        """
+        n = len(chars)
+        keys, counts = self.table()
+        position = np.full(CHINESE_SPACE, -1, dtype=np.int64)
+        position[chinese_ids(chars)] = np.arange(n)
+        a = position[keys // CHINESE_SPACE ** 2]
+        b = position[keys // CHINESE_SPACE % CHINESE_SPACE]
+        c = position[keys % CHINESE_SPACE]
+        keep = (a >= 0) & (b >= 0) & (c >= 0)
+        return sparse.csr_matrix((counts[keep], (a[keep] * n + b[keep], c[keep])), shape=(n * n, n))
+
+
+POSITIONS = 8  # positions in a line counted apart; later ones share the last column
+
+
+class PositionAccumulator:
+    """
+    Position-specific character counts from the parsed lines (Chunk.lines), as
+    CHINESE_SPACE arrays indexed by chinese_ids: per position in the line (`positions`,
+    a CHINESE_SPACE x POSITIONS matrix), at the end of any line (`line_end`) and in the
+    rhyme position, the end of the second line of a couplet (`rhyme`).
+    """
+
+    version = 2
+
+    def __init__(self):
+        self.positions = np.zeros((CHINESE_SPACE, POSITIONS), dtype=np.int64)
+        self.line_end = np.zeros(CHINESE_SPACE, dtype=np.int64)
+        self.rhyme = np.zeros(CHINESE_SPACE, dtype=np.int64)
+
+    def update(self, chunk):
+        codes, _ = chunk.encoded()
+        spans, numbers = chunk.lines()
+        ids, chinese = code_ids(codes)
+        lengths = spans[:, 1] - spans[:, 0]
+        position = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        where = np.repeat(spans[:, 0] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        counted = chinese[where]
+        np.add.at(self.positions, (ids[where][counted], np.minimum(position[counted], POSITIONS - 1)), 1)
+        # a line ending on another kind of character (e.g. an illegible □) has no known rhyme
+        last = spans[:, 1] - 1
+        ends, counted = ids[last], chinese[last]
+        self.line_end += np.bincount(ends[counted], minlength=CHINESE_SPACE)
+        self.rhyme += np.bincount(ends[counted & (numbers % 2 == 1)], minlength=CHINESE_SPACE)
+
+    def merge(self, other):
+        self.positions += other.positions
+        self.line_end += other.line_end
+        self.rhyme += other.rhyme
+
+    def count(self, chars, where='rhyme'):
+        """Counts of chars in the rhyme position, at line ends ('line_end') or at a position in the line (an int)."""
+        ids = chinese_ids(chars)
+        if isinstance(where, int):
+            return self.positions[ids, min(where, POSITIONS - 1)]
+        return getattr(self, where)[ids]
+
+
+ACCUMULATORS = {
+    'frequency': FrequencyAccumulator,
+    'diversity': DiversityAccumulator,
+    'content_diversity': ContentDiversityAccumulator,
+    'bigram': BigramAccumulator,
+    'neighbor': NeighborAccumulator,
+    'sentences': SentenceAccumulator,
+    'trigram': TrigramAccumulator,
+    'position': PositionAccumulator,
+}
+WINDOW_KIND = re.compile(r'window(\d+)')
+
+
+def accumulator_class(kind):
+    return WindowAccumulator if WINDOW_KIND.fullmatch(kind) else ACCUMULATORS[kind]
+
+
+def new_accumulator(kind):
+    """An empty accumulator of a kind; 'window{k}' counts the ±k window."""
+    match = WINDOW_KIND.fullmatch(kind)
+    return WindowAccumulator(int(match.group(1))) if match else ACCUMULATORS[kind]()
+
+
+def iter_chunks(path, chunksize=CHUNKSIZE, start=0, stop=None, byte_range=None):
+    """Chunks of the `内容` column, optionally limited to the data rows [start, stop) (see iter_column)."""
+    # read from the Parquet copy when there is one; missing poems read as 'nan' either way
+    for contents in iter_column(path, '内容', chunksize, start, stop, byte_range):
+        yield Chunk(['nan' if content is None else str(content) for content in contents])
+
+
+def scan_corpus(paths, accumulators, chunksize=CHUNKSIZE):
+    """Read every file once, in chunks, and feed each chunk to all accumulators."""
+    for path in paths:
+        for chunk in iter_chunks(path, chunksize):
+            for accumulator in accumulators:
+                accumulator.update(chunk)
+    return accumulators
+
+
+def read_manifest():
+    """The manifest written by utils.get_dynasty_corpus, {} if there is none."""
+    path = CORPUS / 'dynasty_corpus' / MANIFEST_NAME
+    if not path.exists():
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def manifest_entry(dy):
+    """The manifest entry of a dynasty while its CSV is still the file it describes, else None."""
+    entry = read_manifest().get(dy)
+    path = CORPUS / 'dynasty_corpus' / f'{dy}.csv'
+    if entry is None or not path.exists():
+        return None
+    stat = path.stat()
+    return entry if (entry['size'], entry['mtime_ns']) == (stat.st_size, stat.st_mtime_ns) else None
+
+
+def shard_plan(dy, encoded):
+    """
+    (rows, cuts, offsets) of a slice corpus for the shards of scan_dynasties: its number of
+    rows, the rows a shard may start at (None for any row) and the byte offset of every row of
+    a CSV (None for the other formats). Shards of a Parquet copy start at its row groups, so no
+    group is decoded twice; those of a CSV seek to their first row. The CSV offsets take one pass
+    over the file and are kept in the stage cache.
+    """
+    if encoded:
+        return len(TokenCorpus(dy)), None, None
+    path = dynasty_path(dy)
+    if path.suffix == '.parquet':
+        starts = row_group_starts(path)
+        return int(starts[-1]), starts, None
+    offsets = cached(f'rows_{dy}', stage_key(path, 'rows'), lambda: csv_row_offsets(path))
+    return len(offsets) - 1, None, offsets
+
+
+def shard_ranges(rows, size, cuts=None):
+    """[start, stop) ranges of about `size` rows covering [0, rows), starting only at `cuts` when given."""
+    starts = range(0, rows, size)
+    if cuts is not None:
+        starts = sorted({int(cuts[np.searchsorted(cuts, start)]) for start in starts} - {rows})
+    starts = list(starts)
+    return list(zip(starts, starts[1:] + [rows]))
+
+
+def dynasty_path(dy):
+    """The corpus file of a slice: its Parquet copy when it is current, else the CSV."""
+    return source_path(CORPUS / 'dynasty_corpus' / f'{dy}.csv')
+
+
+def period_slices(periods):
+    """The slices making up the given periods (config.PERIODS), each once, in time order."""
+    slices = {name for period in periods for name in PERIODS.get(period, [period])}
+    return [name for name in SLICES if name in slices] + sorted(slices - set(SLICES))
+
+
+def period_paths(period):
+    """The corpus files of the slices of a period that exist."""
+    return [dynasty_path(name) for name in PERIODS.get(period, [period]) if dynasty_path(name).exists()]
+
+
+# Encoded dynasty corpora: one global vocabulary (sorted code points, a token id being
+# the index in it) and per dynasty a uint16/uint32 token array of the raw `内容` text,
+# the poem offsets (poem i is tokens[poems[i]:poems[i + 1]]), the (start, end) spans
+# of the Word2Vec sentences and the parsed lines: their (start, end) spans and their
+# uint16 number within the poem, which gives the couplets and the rhyme position (see
+# line_spans). The arrays are memory-mapped, so shard workers share them through the
+# page cache.
+TOKENS = OUTPUT / 'tokens'
+TOKENS_VERSION = 3
+
+
+class TokenCorpus:
+
+    def __init__(self, dy):
+        self.vocab = np.load(TOKENS / 'vocab.npy')
+        self.tokens = np.load(TOKENS / f'{dy}.tokens.npy', mmap_mode='r')
+        self.poems = np.load(TOKENS / f'{dy}.poems.npy', mmap_mode='r')
+        self.sentences = np.load(TOKENS / f'{dy}.sentences.npy', mmap_mode='r')
+        self.lines = np.load(TOKENS / f'{dy}.lines.npy', mmap_mode='r')
+        self.line_numbers = np.load(TOKENS / f'{dy}.line_numbers.npy', mmap_mode='r')
+        self._deleted = {}
+
+    def __len__(self):
+        return len(self.poems) - 1
+
+    def deleted(self, pattern):
+        """Which token ids a cleaning pattern removes."""
+        if pattern not in self._deleted:
+            self._deleted[pattern] = pattern_mask(pattern, self.vocab)
+        return self._deleted[pattern]
+
+    def chunks(self, chunksize=CHUNKSIZE, start=0, stop=None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        for first in range(start, stop, chunksize):
+            last = min(first + chunksize, stop)
+            low, high = int(self.poems[first]), int(self.poems[last])
+            spans = self.sentences[np.searchsorted(self.sentences[:, 0], low):
+                                   np.searchsorted(self.sentences[:, 0], high)]
+            lines = slice(np.searchsorted(self.lines[:, 0], low), np.searchsorted(self.lines[:, 0], high))
+            yield Chunk.from_tokens(self, np.asarray(self.tokens[low:high]),
+                                    np.asarray(self.poems[first:last + 1]) - low, np.asarray(spans) - low,
+                                    (np.asarray(self.lines[lines]) - low, np.asarray(self.line_numbers[lines])))
+
+
+def _tokens_key(dynasties):
+    paths = [dynasty_path(dy) for dy in dynasties]
+    return stage_key(*paths, TOKENS_VERSION)
+
+
+def encoded_dynasties(dynasties=tuple(SLICES)):
+    """The slices whose encoded corpus is current, [] when any corpus changed since encode_corpora."""
+    if not is_fresh('tokens', _tokens_key(dynasties), [TOKENS / 'vocab.npy']):
+        return []
+    return [dy for dy in dynasties if dynasty_path(dy).exists()]
+
+
+def encode_corpora(dynasties=tuple(SLICES), chunksize=CHUNKSIZE):
+    """
+    Encode every slice corpus once (skipped while none changed). Code points go to a
+    temporary uint32 file in the first pass, which also collects the vocabulary; they are
+    then rewritten as token ids of the smallest dtype that fits.
+    """
+    key = _tokens_key(dynasties)
+    if is_fresh('tokens', key, [TOKENS / 'vocab.npy']):
+        return
+    dynasties = [dy for dy in dynasties if dynasty_path(dy).exists()]
+    TOKENS.mkdir(exist_ok=True)
+    vocab = np.zeros(0, dtype=np.uint32)
+    for dy in dynasties:
+        print(f'Encoding {dynasty_path(dy)}')
+        poems, sentences, length = [np.zeros(1, dtype=np.int64)], [np.zeros((0, 2), dtype=np.int64)], 0
+        lines, line_numbers = [np.zeros((0, 2), dtype=np.int64)], [np.zeros(0, dtype=np.uint16)]
+        with open(TOKENS / f'{dy}.codes.tmp', 'wb') as f:
+            for chunk in iter_chunks(dynasty_path(dy), chunksize):
+                codes, offsets = chunk.encoded()
+                f.write(codes.tobytes())
+                vocab = np.union1d(vocab, codes)
+                poems.append(offsets[1:] + length)
+                sentences.append(sentence_spans(codes, offsets) + length)
+                spans, numbers = chunk.lines()
+                lines.append(spans + length)
+                line_numbers.append(numbers.astype(np.uint16))
+                length += len(codes)
+        np.save(TOKENS / f'{dy}.poems.npy', np.concatenate(poems))
+        np.save(TOKENS / f'{dy}.sentences.npy', np.concatenate(sentences))
+        np.save(TOKENS / f'{dy}.lines.npy', np.concatenate(lines))
+        np.save(TOKENS / f'{dy}.line_numbers.npy', np.concatenate(line_numbers))
+
+    np.save(TOKENS / 'vocab.npy', vocab.astype(np.uint32))
+    dtype = np.uint16 if len(vocab) <= 1 << 16 else np.uint32
+    for dy in dynasties:
+        tmp = TOKENS / f'{dy}.codes.tmp'
+        codes = np.fromfile(tmp, dtype=np.uint32) if tmp.stat().st_size else np.zeros(0, dtype=np.uint32)
+        tokens = np.lib.format.open_memmap(TOKENS / f'{dy}.tokens.npy', mode='w+', dtype=dtype, shape=codes.shape)
+        for start in range(0, len(codes), 1 << 24):
+            tokens[start:start + (1 << 24)] = np.searchsorted(vocab, codes[start:start + (1 << 24)])
+        tokens.flush()
+        del tokens, codes
+        tmp.unlink()
+    mark_done('tokens', key)
+
+
+def dynasty_chunks(dy, encoded, start=0, stop=None, byte_range=None):
+    """Chunks of a dynasty corpus, from its encoded arrays when `encoded`, else from the file."""
+    if encoded:
+        return TokenCorpus(dy).chunks(start=start, stop=stop)
+    return iter_chunks(dynasty_path(dy), start=start, stop=stop, byte_range=byte_range)
+
+
+def scan_shard(dy, kinds, start, stop, encoded=False, byte_range=None):
+    """
+    Accumulators of the rows [start, stop) of one dynasty corpus (process pool task).
+    :param byte_range: Where the rows are in a CSV corpus (table_io.csv_byte_range)
+    """
+    accumulators = [new_accumulator(kind) for kind in kinds]
+    for chunk in dynasty_chunks(dy, encoded, start, stop, byte_range):
+        for accumulator in accumulators:
+            accumulator.update(chunk)
+    return accumulators
+
+
+# Kinds that are not in the stage cache (the sentences) are kept in memory for the lifetime
+# of the process. Cached kinds are not: they are written to the stage cache as soon as they
+# are collected and read back by each builder one period at a time, so a full build holds
+# the matrices of one period at once rather than of every period.
+_scans = {}
+
+# Per-dynasty counters are also kept in the stage cache, keyed by the corpus content.
+# Sentences are not: the Word2Vec models trained from them are cached instead.
+CACHED_KINDS = ('frequency', 'diversity', 'bigram', 'neighbor', 'position')
+
+
+def is_cached_kind(kind):
+    return kind in CACHED_KINDS or kind in ('trigram', 'content_diversity') or WINDOW_KIND.fullmatch(kind) is not None
+
+
+def _scan_key(dy, kind):
+    return stage_key(dynasty_path(dy), kind, accumulator_class(kind).version)
+
+
+def _collected(dy, kind):
+    if kind in _scans.get(dy, {}):
+        return True
+    return is_cached_kind(kind) and has_result(f'scan_{dy}_{kind}', _scan_key(dy, kind))
+
+
+def _restore(dy, kinds):
+    found = {}
+    for kind in kinds:
+        if kind in _scans.get(dy, {}):
+            found[kind] = _scans[dy][kind]
+        elif is_cached_kind(kind):
+            accumulator = load_result(f'scan_{dy}_{kind}', _scan_key(dy, kind))
+            if accumulator is not None:
+                found[kind] = accumulator
+    return found
+
+
+def _store(dy, kinds, accumulators):
+    for kind, accumulator in zip(kinds, accumulators):
+        if is_cached_kind(kind):
+            save_result(f'scan_{dy}_{kind}', _scan_key(dy, kind), accumulator)
+        else:
+            _scans.setdefault(dy, {})[kind] = accumulator
+
+
+def scan_dynasty(dy, kinds=('frequency',)):
+    """
+    Accumulators of one period (or slice) corpus, keyed by kind.
+    Results are kept in the stage cache (the sentences in memory), so builders that ask for
+    kinds already collected do not read the corpus again. A period of several slices merges
+    the accumulators of its slices in time order, so overlapping windows share the scan of
+    every slice.
+    """
+    if PERIODS.get(dy, [dy]) != [dy]:
+        return _merge_slices(dy, kinds)
+    return scan_slice(dy, kinds)
+
+
+def scan_slice(dy, kinds=('frequency',)):
+    """Accumulators of one slice corpus, keyed by kind."""
+    found = _restore(dy, kinds)
+    missing = [kind for kind in kinds if kind not in found]
+    if missing:
+        encoded = dy in encoded_dynasties()
+        print(f'Scanning {"encoded " if encoded else ""}{dynasty_path(dy)} for {", ".join(missing)}')
+        accumulators = scan_shard(dy, missing, 0, None, encoded)
+        _store(dy, missing, accumulators)
+        found.update(zip(missing, accumulators))
+    return {kind: found[kind] for kind in kinds}
+
+
+def _merge_slices(period, kinds):
+    # merged periods are kept apart from the slices, which may share their names
+    held = _scans.setdefault(('period', period), {})
+    found = {kind: held[kind] for kind in kinds if kind in held}
+    missing = [kind for kind in kinds if kind not in found]
+    if missing:
+        merged = [new_accumulator(kind) for kind in missing]
+        for name in PERIODS[period]:
+            if not dynasty_path(name).exists():
+                continue
+            partial = scan_slice(name, missing)
+            for kind, accumulator in zip(missing, merged):
+                accumulator.merge(partial[kind])
+        found.update(zip(missing, merged))
+        held.update((kind, accumulator) for kind, accumulator in zip(missing, merged) if not is_cached_kind(kind))
+    return {kind: found[kind] for kind in kinds}
+
+
+def scan_dynasties(dynasties, kinds, jobs=1):
+    """
+    Collect the given kinds for the slices of several periods with a pool of `jobs` processes.
+    Every corpus is cut into row ranges of about 1/jobs of the total rows (see shard_plan), so
+    a large dynasty such as Song is spread over several workers and each worker reads only its
+    own range. Partial accumulators are merged in row order, which keeps the results identical
+    to a serial scan.
+    """
+    dynasties = period_slices(dynasties)
+    if jobs <= 1:
+        for dy in dynasties:
+            scan_slice(dy, kinds)
+        return
+
+    todo = {}
+    for dy in dynasties:
+        missing = [kind for kind in kinds if not _collected(dy, kind)]
+        if missing and dynasty_path(dy).exists():
+            todo[dy] = missing
+    if not todo:
+        return
+
+    # keys are computed here, in the parent, so workers never write the digest cache. Each task
+    # gets all it reads as arguments and returns its partial counts, so nothing depends on
+    # state inherited from the parent and the pool works the same under the spawn start
+    # method of Windows and macOS as under fork.
+    encoded = encoded_dynasties()
+    plans = {dy: shard_plan(dy, dy in encoded) for dy in todo}
+    shard_rows = max(1, math.ceil(sum(rows for rows, _, _ in plans.values()) / jobs))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {}
+        for dy, missing in todo.items():
+            rows, cuts, offsets = plans[dy]
+            futures[dy] = [executor.submit(scan_shard, dy, missing, start, stop, dy in encoded,
+                                           None if offsets is None else csv_byte_range(offsets, start, stop))
+                           for start, stop in shard_ranges(rows, shard_rows, cuts)]
+        for dy, missing in todo.items():
+            print(f'Scanning {dynasty_path(dy)} for {", ".join(missing)} in {len(futures[dy])} shards')
+            accumulators = [new_accumulator(kind) for kind in missing]
+            for future in futures.pop(dy):  # partial results are released once merged
+                for accumulator, partial in zip(accumulators, future.result()):
+                    accumulator.merge(partial)
+            _store(dy, missing, accumulators)
+
+
+def release(kind):
+    """Drop a collected kind from every dynasty, e.g. the sentences once the models are trained."""
+    for held in _scans.values():
+        held.pop(kind, None)
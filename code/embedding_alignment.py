@@ -1,131 +1,350 @@
 import re
+import sys
+import json
 import numpy as np
 from scipy.linalg import svd, orthogonal_procrustes
+from alignment import EmbeddingAligner, MODES, common_words, frequency_anchors
 import glob
 from config import *
+from corpus_scanner import dynasty_path, dynasty_chunks, encoded_dynasties, manifest_entry, period_paths
+from stage_cache import stage_key, is_fresh, mark_done, load_result, save_result
+from table_io import read_table
 import pandas as pd
-from gensim.models import Word2Vec
+from gensim.models import Word2Vec, KeyedVectors
 import os
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import resource
+except ImportError:  # not available on Windows; peak RSS is then not reported
+    resource = None
 
 from sklearn.metrics.pairwise import cosine_similarity
 
-def train_dynasty_word2vec():
-    chinese_pattern = re.compile(r'[a-zA-Z,.?()（）【】\[\]!，\'" ]+')
-    dynasties = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
+# One training run of 10 epochs with a linear learning rate decay from alpha to min_alpha.
+# Worker threads only change speed, so they are not part of the model's cache key.
+WORD2VEC_PARAMS = dict(vector_size=300, window=5, min_count=5, sg=1, epochs=10, alpha=0.025, min_alpha=0.0001)
+WORD2VEC_VERSION = 1  # bump when the training sentences change, so the models are retrained
+WORD2VEC_WORKERS = os.cpu_count() or 4
+EMBEDDING_DIR = ROOT.parent /'Diachronic_sub-database'/'Dynasty_embeddings'
+SENTENCES_DIR = OUTPUT / 'sentences'
+# Aligned matrices ({dy}_aligned.npy, rows in the order of vocab.npy) and the rotations
+# that produced them ({dy}_rotation.npy). The shared space is that of the reference, the
+# first period, in the reference and chained modes (its rotation is the identity), and the
+# mean of all spaces in the generalized mode
+ALIGNED_DIR = EMBEDDING_DIR / 'aligned_word_vectors'
+ALIGNMENT_RECORD = ALIGNED_DIR / 'alignment.json'  # the configuration the matrices were aligned with
 
-    # Ensure the output directory exists
-    output_dir = ROOT.parent /'Diachronic_sub-database'/'Dynasty_embeddings'
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+def word2vec_key(dy):
+    return stage_key(*period_paths(dy), WORD2VEC_PARAMS, WORD2VEC_VERSION)
 
-    for dy in dynasties:
-        print(f"Training Word2Vec model for {dy} dynasty...")
-        corpus_dynasty = []  # Initialize corpus for the current dynasty
 
-        # Load poetry files for the current dynasty
-        dir_dynasty = CORPUS/'dynasty_corpus'/ fr'{dy}.csv'
-        # for path in glob(dir_dynasty):
-        print(f"Processing file: {dir_dynasty}")
-        pd_dy = pd.read_csv(dir_dynasty)
-        for idx, row in pd_dy.iterrows():
-            # Combine title, author, and content
+def stale_word2vec(dynasties):
+    """Dynasties whose model is missing or was trained on a different corpus."""
+    return [dy for dy in dynasties
+            if not is_fresh(f'word2vec_{dy}', word2vec_key(dy), [EMBEDDING_DIR / f'{dy}_word2vec.model'])]
 
-            content = str(row["内容"])
-            # Remove non-Chinese characters
-            content_clean = chinese_pattern.sub('', content)
-            # Split into sentences and convert to lists of characters
-            content_clean = re.split('。|？|！|，', content_clean)
-            content_clean = [list(i) for i in content_clean if i]
-            corpus_dynasty.extend(content_clean)
 
-        # Train Word2Vec model for the current dynasty
-        if corpus_dynasty:
-            model = Word2Vec(sentences=corpus_dynasty, vector_size=300, window=5, min_count=5, sg=1, workers=4)
-            model.train(corpus_dynasty, total_examples=model.corpus_count, epochs=10)
+def _sources_key(dy):
+    # the sources a model was trained on are recorded against the model file itself
+    return stage_key(EMBEDDING_DIR / f'{dy}_word2vec.model', WORD2VEC_PARAMS)
 
-            # Save the model
-            model_path = os.path.join(output_dir, f'{dy}_word2vec.model')
-            model.save(model_path)
-            print(f"Word2Vec model for {dy} dynasty saved to {model_path}")
 
+def _period_entry(dy):
+    # only a period of one slice has a single corpus whose sources can be followed
+    slices = PERIODS.get(dy, [dy])
+    return manifest_entry(slices[0]) if len(slices) == 1 else None
 
 
+def appended_rows(dy):
+    """
+    The rows [start, stop) added to a dynasty corpus since its model was trained, when the
+    corpus is the old one with new source files after it (see utils.get_dynasty_corpus);
+    None when the model has to be trained from scratch.
+    """
+    entry = _period_entry(dy)
+    trained = load_result(f'word2vec_sources_{dy}', _sources_key(dy))
+    if entry is None or trained is None:
+        return None
+    if len(entry['sources']) <= len(trained) or entry['sources'][:len(trained)] != trained:
+        return None
+    return sum(source['rows'] for source in trained), entry['rows']
+
+
+def _trained(dy, key):
+    mark_done(f'word2vec_{dy}', key)
+    entry = _period_entry(dy)
+    if entry is not None:
+        save_result(f'word2vec_sources_{dy}', _sources_key(dy), entry['sources'])
+
+
+def write_sentences(dy, path, encoded=(), start=0, stop=None):
+    """
+    Write the Word2Vec sentences of a period in LineSentence format (one sentence per line,
+    characters separated by spaces), slice by slice and chunk by chunk. Whitespace characters
+    left in the poems (line breaks, full-width spaces) cannot be tokens of this format and
+    are dropped. Rows [start, stop) are only used for periods of one slice.
+    :param encoded: The slices read from their encoded arrays
+    :return: The number of sentences
+    """
+    count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        for name in PERIODS.get(dy, [dy]):
+            if not dynasty_path(name).exists():
+                continue
+            for chunk in dynasty_chunks(name, name in encoded, start, stop):
+                for sentence in chunk.sentences():
+                    line = ' '.join(char for char in sentence if not char.isspace())
+                    if line:
+                        f.write(line + '\n')
+                        count += 1
+    return count
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process so far, in MB (None where unknown). It is the high-water
+    mark of the process's lifetime: after several models it is the largest of them, not the last.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def train_word2vec(dy, output_dir, encoded=(), workers=WORD2VEC_WORKERS, rows=None):
+    """
+    Train the model of a dynasty, or with rows=(start, stop) continue training the saved
+    model on those rows only: new characters are added to its vocabulary, and the same
+    epochs and learning rate schedule are run over the new sentences.
+    """
+    model_path = os.path.join(output_dir, f'{dy}_word2vec.model')
+    print(f"{'Updating' if rows else 'Training'} Word2Vec model for {dy} dynasty...")
+    start = time.perf_counter()
+    # Sentences are streamed from a LineSentence file rather than held as lists in memory
+    SENTENCES_DIR.mkdir(exist_ok=True)
+    corpus_file = SENTENCES_DIR / f'{dy}.txt'
+    try:
+        if not write_sentences(dy, corpus_file, encoded, *(rows or ())):
+            return rows is not None  # nothing new: the saved model is still current
+        if rows is None:
+            # Train Word2Vec model for the current dynasty
+            model = Word2Vec(corpus_file=str(corpus_file), workers=workers, **WORD2VEC_PARAMS)
+        else:
+            model = Word2Vec.load(model_path)
+            model.workers = workers
+            model.build_vocab(corpus_file=str(corpus_file), update=True)
+            model.train(corpus_file=str(corpus_file), total_examples=model.corpus_count,
+                        total_words=model.corpus_total_words, epochs=model.epochs)
+    finally:
+        corpus_file.unlink(missing_ok=True)
+
+    # Save the model, and its word vectors alone for readers that do not train
+    model.save(model_path)
+    model.wv.save(os.path.join(output_dir, f'{dy}_word2vec.kv'), separately=['vectors'])
+    rss = peak_rss_mb()
+    print(f"Word2Vec model for {dy} dynasty saved to {model_path} "
+          f"({time.perf_counter() - start:.1f}s" + (f", process peak RSS {rss:.0f} MB)" if rss is not None else ")"))
+    return True
+
+
+def train_dynasty_word2vec(jobs=1, workers=WORD2VEC_WORKERS, incremental=False):
+    """
+    Train the models of the dynasties whose corpus changed. With incremental, a model whose
+    corpus only gained new source files is updated with their poems instead of retrained.
+    """
+    dynasties = DYNASTIES
+
+    # Ensure the output directory exists
+    output_dir = EMBEDDING_DIR
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # models whose dynasty corpus is unchanged are not retrained
+    stale = stale_word2vec(dynasties)
+    keys = {dy: word2vec_key(dy) for dy in stale}
+    encoded = encoded_dynasties()
+    rows = {dy: appended_rows(dy) if incremental else None for dy in stale}
+    if jobs <= 1:
+        for dy in stale:
+            if train_word2vec(dy, output_dir, encoded, workers, rows[dy]):
+                _trained(dy, keys[dy])
+        return
+
+    # the dynasties are independent: one process per model, each with its share of the threads.
+    # A task streams its sentences from the corpus files named by its arguments and returns
+    # only whether it saved a model, so it runs the same under spawn (Windows, macOS) as under fork
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {dy: executor.submit(train_word2vec, dy, output_dir, encoded, max(1, workers // jobs), rows[dy])
+                   for dy in stale}
+        for dy, future in futures.items():
+            if future.result():
+                _trained(dy, keys[dy])
 
-def align_embedding_space():
-    def align_embeddings(reference_matrix, target_matrix):
-        """
-        Align the target embedding matrix to the reference embedding matrix
-        :param reference_matrix: The reference embedding matrix (number of words x dimension)
-        :param target_matrix: The target embedding matrix (number of words x dimension)
-        :return: The aligned target embedding matrix
-        """
-        R, _ = orthogonal_procrustes(target_matrix, reference_matrix)
-        aligned_matrix = target_matrix @ R
-        return aligned_matrix
 
-    def align_all_embeddings(models):
+
+
+def align_embedding_space(export_txt=False, mode='reference', anchors=None):
+    """
+    Align the dynasty models into one space (see alignment.py for the modes; the reference
+    is the first period, Tang) and save the aligned matrices of their common characters.
+    :param anchors: The characters the rotations are fitted on, e.g. alignment.frequency_anchors;
+                    by default all common characters
+    :return: (aligned matrices, common vocabulary, the KeyedVectors of the models). The models
+             are their word vectors (load_word_vectors), not the Word2Vec objects returned
+             before; load those with Word2Vec.load to continue training.
+    """
+    def common_vocabulary(models):
         """
-        Align multiple embedding matrices to the same reference space
-        :param models: A list of Word2Vec models
-        :return: The list of aligned embedding matrices and the common vocabulary
+        :param models: A list of KeyedVectors
+        :return: The sorted characters that are in every model and in the frequency table
         """
-        # Get the common vocabulary of all models
         freq_df_path = ROOT.parent /'Diachronic_sub-database' / 'Diachronic_data' / 'Diachronic_character_frequencies.csv'
-        freq_df = pd.read_csv(freq_df_path)
+        freq_df = read_table(freq_df_path, ['Character'])
         common_characters= freq_df['Character']
-        common_vocab = set(models[0].wv.index_to_key)
+        common_vocab = set(models[0].index_to_key)
         for model in models[1:]:
-            common_vocab.intersection_update(model.wv.index_to_key)
+            common_vocab.intersection_update(model.index_to_key)
         common_vocab.intersection_update(common_characters)
 
-        common_vocab = sorted(list(common_vocab))  # Sort for consistency
+        return sorted(list(common_vocab))  # Sort for consistency
 
-        # Build the embedding matrices for the common vocabulary
-        embedding_matrices = []
-        for model in models:
 
-            matrix = np.array([model.wv[word] for word in common_vocab])
-            embedding_matrices.append(matrix)
+    dynasty = DYNASTIES
+    anchors = None if anchors is None else sorted(anchors)
+    # Load the word vectors of the period models and extract the embedding matrices
+    model_paths = [word_vectors_path(dy) for dy in dynasty]
+    models = [load_word_vectors(dy) for dy in dynasty]
+    ALIGNED_DIR.mkdir(parents=True, exist_ok=True)
 
-        # Use the first embedding matrix as the reference
-        reference_matrix = embedding_matrices[0]
+    common_vocab = common_vocabulary(models)
+    aligner = EmbeddingAligner(dict(zip(dynasty, models)), mode, dynasty[0],
+                               common_vocab if anchors is None else anchors, dict(zip(dynasty, model_paths)))
+    vocab_path = ALIGNED_DIR / 'vocab.npy'
+    if not vocab_path.exists() or np.load(vocab_path).tolist() != common_vocab:
+        np.save(vocab_path, np.array(common_vocab))
 
-        # Align all other embedding matrices to the reference space
-        aligned_matrices = [reference_matrix]
-        for matrix in embedding_matrices[1:]:
-            aligned_matrix = align_embeddings(reference_matrix, matrix)
+    # An aligned matrix is reused while its rotation's inputs (see EmbeddingAligner.depends_on)
+    # and the common vocabulary are unchanged, so in the reference mode updating one dynasty
+    # only realigns that one
+    aligned_matrices = []
+    for dy, model in zip(dynasty, models):
+        key = stage_key(aligner.key(dy), common_vocab)
+        rotation_path, aligned_path = ALIGNED_DIR / f'{dy}_rotation.npy', ALIGNED_DIR / f'{dy}_aligned.npy'
+        vectors_path = ALIGNED_DIR / f'{dy}_word2vec.txt'
+        fresh = is_fresh(f'aligned_{dy}', key, [rotation_path, aligned_path])
+        if fresh:
+            aligned_matrices.append(np.load(aligned_path, mmap_mode='r'))
+        else:
+            print(f'Aligning {dy} ({mode} mode)')
+            R = aligner.rotation(dy)
+            aligned_matrix = model[common_vocab] @ R
+            np.save(rotation_path, R)
+            np.save(aligned_path, aligned_matrix)
+            mark_done(f'aligned_{dy}', key)
             aligned_matrices.append(aligned_matrix)
 
-        return aligned_matrices, common_vocab
+        # The text format of earlier releases, on request
+        if export_txt and not (fresh and vectors_path.exists()):
+            aligned_matrix = aligned_matrices[-1]
+            with open(vectors_path, 'w', encoding='utf-8') as f:
+                f.write(f"{len(common_vocab)} {aligned_matrix.shape[1]}\n")
+                for j, word in enumerate(common_vocab):
+                    vector = ' '.join(map(str, aligned_matrix[j]))
+                    f.write(f"{word} {vector}\n")
 
+    with open(ALIGNMENT_RECORD, 'w', encoding='utf-8') as f:
+        json.dump({'dynasties': dynasty, 'mode': mode, 'anchors': anchors}, f, ensure_ascii=False)
+    mark_done('aligned_space', _space_key(dynasty, mode, anchors))
+    return aligned_matrices, common_vocab, models  # Output the aligned embedding spaces
 
-    dynasty = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
-    # Example: Load 6 Word2Vec models and extract the embedding matrices
-    model_dir= ROOT.parent /'Diachronic_sub-database'/'Dynasty_embeddings'
-    model_paths = [model_dir /f'{dy}_Word2vec.model' for dy in dynasty]
-    model_paths = [str(path) for path in model_paths]
-    models = [Word2Vec.load(path) for path in model_paths]
 
-    # Align all embedding matrices
-    aligned_matrices, common_vocab = align_all_embeddings(models)
+def word_vectors_path(dy):
+    """The file load_word_vectors reads: {dy}_word2vec.kv, unless it is missing or older than the model."""
+    model_path, kv_path = EMBEDDING_DIR / f'{dy}_word2vec.model', EMBEDDING_DIR / f'{dy}_word2vec.kv'
+    if kv_path.exists() and (not model_path.exists() or kv_path.stat().st_mtime_ns >= model_path.stat().st_mtime_ns):
+        return kv_path
+    return model_path
 
-    # Save the aligned word vectors for each model
-    for i, dy in enumerate(dynasty):
 
-        aligned_matrix = aligned_matrices[i]
-        embedding_path=ROOT.parent /'Diachronic_sub-database'/ 'Dynasty_embeddings'/'aligned_word_vectors'
-        if not os.path.exists(embedding_path):
-            os.makedirs(embedding_path, exist_ok=True)
-        with open(embedding_path /f'{dy}_word2vec.txt', 'w', encoding='utf-8') as f:
-            f.write(f"{len(common_vocab)} {aligned_matrix.shape[1]}\n")
-            for j, word in enumerate(common_vocab):
-                vector = ' '.join(map(str, aligned_matrix[j]))
-                f.write(f"{word} {vector}\n")
+def load_word_vectors(dy):
+    """
+    The word vectors (KeyedVectors) of a dynasty model, memory-mapped from {dy}_word2vec.kv;
+    the full model is only loaded when that file is missing or older than the model.
+    """
+    path = word_vectors_path(dy)
+    if path.suffix == '.kv':
+        return KeyedVectors.load(str(path), mmap='r')
+    return Word2Vec.load(str(path)).wv
 
-    return aligned_matrices, common_vocab, models  # Output the aligned embedding spaces
+
+def _space_key(dynasties, mode, anchors):
+    # the aligned matrices hold while the models, the character list and the configuration are unchanged
+    freq_df_path = ROOT.parent / 'Diachronic_sub-database' / 'Diachronic_data' / 'Diachronic_character_frequencies.csv'
+    return stage_key(list(dynasties), *[word_vectors_path(dy) for dy in dynasties], freq_df_path, mode, anchors)
+
+
+def alignment_record():
+    """{'dynasties', 'mode', 'anchors'} of the last align_embedding_space, or None."""
+    if not ALIGNMENT_RECORD.exists():
+        return None
+    with open(ALIGNMENT_RECORD, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_aligned_embeddings(dynasties=tuple(DYNASTIES)):
+    """
+    The matrices saved by align_embedding_space, memory-mapped, without loading any model.
+    :return: ({dynasty: aligned matrix}, common vocabulary), or None when they were not saved
+             or are stale: a model was retrained or the character list changed since
+    """
+    paths = [ALIGNED_DIR / 'vocab.npy'] + [ALIGNED_DIR / f'{dy}_aligned.npy' for dy in dynasties]
+    record = alignment_record()
+    if record is None or not set(dynasties) <= set(record['dynasties']):
+        return None
+    if not is_fresh('aligned_space', _space_key(record['dynasties'], record['mode'], record['anchors']), paths):
+        return None
+    common_vocab = np.load(ALIGNED_DIR / 'vocab.npy').tolist()
+    return {dy: np.load(ALIGNED_DIR / f'{dy}_aligned.npy', mmap_mode='r') for dy in dynasties}, common_vocab
+
+
+def aligned_embeddings(dynasties=tuple(DYNASTIES)):
+    """
+    load_aligned_embeddings, aligning the models first when the saved matrices are missing or
+    stale, in the mode and with the anchors of the last alignment.
+    """
+    saved = load_aligned_embeddings(dynasties)
+    if saved is None:
+        record = alignment_record() or {}
+        align_embedding_space(mode=record.get('mode', 'reference'), anchors=record.get('anchors'))
+        saved = load_aligned_embeddings(dynasties)
+    return saved
+
+
+def load_rotation(dy):
+    """
+    The rotation taking the vectors of a dynasty model into the shared space of the last
+    alignment: the space of the first period (Tang), or their mean space in the generalized mode.
+    """
+    return np.load(ALIGNED_DIR / f'{dy}_rotation.npy', mmap_mode='r')
 
 
 if __name__ == "__main__":
-    train_dynasty_word2vec()
-    align_embedding_space()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='dynasty models trained in parallel')
+    parser.add_argument('--workers', type=int, default=WORD2VEC_WORKERS, help='Word2Vec threads, shared by the parallel models')
+    parser.add_argument('--incremental', action='store_true',
+                        help='update the models of dynasties that only gained new source files instead of retraining them')
+    parser.add_argument('--export-txt', action='store_true', help='also write the aligned vectors as text')
+    parser.add_argument('--mode', choices=MODES, default='reference', help='alignment mode')
+    parser.add_argument('--anchors', type=int, default=None,
+                        help='fit the rotations on the N most frequent common characters only')
+    args = parser.parse_args()
+    train_dynasty_word2vec(args.jobs, args.workers, args.incremental)
+    anchors = None
+    if args.anchors:
+        anchors = frequency_anchors(common_words({dy: load_word_vectors(dy) for dy in DYNASTIES}), args.anchors)
+    align_embedding_space(args.export_txt, args.mode, anchors)
\ No newline at end of file
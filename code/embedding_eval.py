@@ -6,77 +6,133 @@ import random
 random.seed(200)
 
 from utils import *
+from embedding_alignment import (load_word_vectors, word_vectors_path, load_rotation, load_aligned_embeddings,
+                                 alignment_record)
+from alignment import EmbeddingAligner, common_words
+from bootstrap import spearman_permutation
 
-def spearman_correlation(dy1, dy2):
+class EvaluationSession:
     """
-    Calculate the Spearman rank correlation coefficient between human scores and semantic similarities.
+    Human scores, word vectors and the rotation of each dynasty pair, loaded once and shared
+    by every comparison. By default each pair is fitted on its own by alignment.EmbeddingAligner,
+    anchored on the common words that are not scored. With pairwise=False the rotations saved
+    by align_embedding_space are reused instead, which requires that alignment to be current and
+    anchored on held-out words only:
+
+    >>> align_embedding_space(anchors=EvaluationSession().held_out_anchors())
+    >>> session = EvaluationSession(pairwise=False)
+    >>> embedding_similarity, score_dict, correlation, p_value = session.spearman_correlation('Tang', 'Song')
     """
-    # Extract human scores
-    score_dict = {}
-
-    paths = SOURCE.glob(fr'human_score\*.xlsx')
-    paths = [file for file in paths if not os.path.basename(file).startswith("~$")]
-
-    for path in paths:
-        xlsx_df = pd.read_excel(path,engine='openpyxl')
-        for idx, row in xlsx_df.iterrows():
-            if len(row[0]) == 1:  # Ensure it's a single character
-                char = row[0]
-                score = row[2]
-                if char in score_dict.keys():
-                    score_dict[char].append(score)
-                else:
-                    score_dict[char] = []
-                    score_dict[char].append(score)
-    score_dict = {k: np.mean(v) for k, v in score_dict.items()}  # Calculate the average score for each character
-
-    path1 =str( ROOT.parent/'Diachronic_sub-database'/ 'Dynasty_embeddings'/f'{dy1}_word2vec.model')
-    path2 =str( ROOT.parent/ 'Diachronic_sub-database'/'Dynasty_embeddings'/f'{dy2}_word2vec.model')
-
-
-    dy1_model = Word2Vec.load(path1)
-    dy2_model = Word2Vec.load(path2)
-
-    # Get the common vocabulary between the two models
-    common_words = list(set(dy1_model.wv.index_to_key) & set(dy2_model.wv.index_to_key))
-
-    # Check if anchor words overlap with scored words (comment out to allow overlap, do not remove overlapping words)
-    common_words = [i for i in common_words if i not in score_dict.keys()]
 
-    # Build the word vector matrices for the common vocabulary
-    dy1_matrix = np.array([dy1_model.wv[word] for word in common_words])
-    dy2_matrix = np.array([dy2_model.wv[word] for word in common_words])
+    def __init__(self, score_dir=SOURCE / 'human_score', pairwise=True):
+        self.score_dir = score_dir
+        self.pairwise = pairwise
+        self._scores = None
+        self._vectors = {}
+        self._rotations = {}
+
+    @property
+    def scores(self):
+        """{character: average human score} over every sheet of score_dir."""
+        if self._scores is None:
+            paths = sorted(path for path in self.score_dir.glob('*.xlsx') if not path.name.startswith("~$"))
+            frames = []
+            for path in paths:
+                xlsx_df = pd.read_excel(path, engine='openpyxl')
+                frames.append(pd.DataFrame({'char': xlsx_df.iloc[:, 0], 'score': xlsx_df.iloc[:, 2]}))
+            scores = pd.concat(frames) if frames else pd.DataFrame({'char': [], 'score': []})
+            # Ensure it's a single character
+            scores = scores[scores['char'].map(lambda char: isinstance(char, str) and len(char) == 1)]
+            # Calculate the average score for each character, in order of first appearance
+            self._scores = scores.groupby('char', sort=False)['score'].mean().to_dict()
+        return self._scores
+
+    def vectors(self, dy):
+        if dy not in self._vectors:
+            self._vectors[dy] = load_word_vectors(dy)
+        return self._vectors[dy]
+
+    def rotation(self, dy1, dy2):
+        """Rotation taking the vectors of dy2 into the space of dy1."""
+        if (dy1, dy2) in self._rotations:
+            return self._rotations[dy1, dy2]
+        if not self.pairwise:
+            self._check_saved_alignment()
+            # dy2 into the shared space, then out of it into dy1's; orthogonal, so R1.T inverts R1
+            self._rotations[dy1, dy2] = np.asarray(load_rotation(dy2)) @ np.asarray(load_rotation(dy1)).T
+        else:
+            vectors = {dy1: self.vectors(dy1), dy2: self.vectors(dy2)}
+            # Anchor words: the common vocabulary minus the scored words (do not remove this filter)
+            anchors = [word for word in common_words(vectors) if word not in self.scores]
+            aligner = EmbeddingAligner(vectors, 'reference', dy1, anchors,
+                                       {dy: word_vectors_path(dy) for dy in vectors})
+            self._rotations[dy1, dy2] = aligner.rotation(dy2)
+        return self._rotations[dy1, dy2]
+
+    def held_out_anchors(self, dynasties=DYNASTIES):
+        """The words common to every dynasty model that are not scored, for align_embedding_space."""
+        return [word for word in common_words({dy: self.vectors(dy) for dy in dynasties}) if word not in self.scores]
+
+    def _check_saved_alignment(self):
+        # never realign from here: the saved space is only read
+        if load_aligned_embeddings() is None:
+            raise RuntimeError('The saved alignment is missing or stale; run align_embedding_space first')
+        anchors = alignment_record()['anchors']
+        if anchors is None or not self.scores.keys().isdisjoint(anchors):
+            raise ValueError('The saved rotations are fitted on scored words; align with '
+                             'anchors=held_out_anchors(), or evaluate with pairwise=True')
+
+    def similarities(self, dy1, dy2):
+        """Cosine similarity of every scored word in both models, with dy2 aligned to dy1, in one pass."""
+        dy1_wv, dy2_wv = self.vectors(dy1), self.vectors(dy2)
+        words = [word for word in self.scores if word in dy1_wv and word in dy2_wv]
+        if not words:
+            return {}
+        dy1_matrix = dy1_wv[words]
+        aligned_dy2_matrix = dy2_wv[words] @ self.rotation(dy1, dy2)
+        similarity = np.einsum('ij,ij->i', dy1_matrix, aligned_dy2_matrix) / (
+            np.linalg.norm(dy1_matrix, axis=1) * np.linalg.norm(aligned_dy2_matrix, axis=1))
+        return dict(zip(words, similarity))
+
+    def spearman_correlation(self, dy1, dy2):
+        """
+        Calculate the Spearman rank correlation coefficient between human scores and semantic similarities.
+        """
+        score_dict = self.scores
+        embedding_similarity = self.similarities(dy1, dy2)
+        human_scores = [score_dict[word] for word in embedding_similarity]
+        machine_similarities = list(embedding_similarity.values())
+        correlation, p_value = spearmanr(human_scores, machine_similarities)
+        return embedding_similarity, score_dict, correlation, p_value
+
+    def permutation_test(self, dy1, dy2, permutations=10000, seed=200):
+        """Spearman correlation with a permutation p-value instead of spearmanr's asymptotic one."""
+        embedding_similarity = self.similarities(dy1, dy2)
+        human_scores = [self.scores[word] for word in embedding_similarity]
+        return spearman_permutation(human_scores, list(embedding_similarity.values()), permutations, seed)
+
+    def sweep(self, dynasties=tuple(DYNASTIES)):
+        """Spearman correlation and p-value of every pair of dynasties, as a DataFrame."""
+        rows = []
+        for i, dy1 in enumerate(dynasties):
+            for dy2 in dynasties[i + 1:]:
+                _, _, correlation, p_value = self.spearman_correlation(dy1, dy2)
+                rows.append({'dy1': dy1, 'dy2': dy2, 'correlation': correlation, 'p_value': p_value})
+        return pd.DataFrame(rows)
+
+
+_session = None
 
-    # Align the two vector spaces
-    U, _, Vt = svd(dy2_matrix.T @ dy1_matrix)
-    # Compute the rotation matrix
-    R = U @ Vt
 
-    # Extract words from the list
-    words = list(score_dict.keys())
-
-    # Calculate semantic similarities
-    embedding_similarity = {}
-    for word in words:
-        if word in dy1_model.wv and word in dy2_model.wv:
-            dy1_vec = dy1_model.wv[word]
-            aligned_dy2_vec = dy2_model.wv[word] @ R
-            similarity = np.dot(dy1_vec, aligned_dy2_vec) / (np.linalg.norm(dy1_vec) * np.linalg.norm(aligned_dy2_vec))
-            embedding_similarity[word] = similarity
-
-    # Extract human scores and semantic similarities
-    human_scores = []
-    machine_similarities = []
-    for word in score_dict:
-        if word in embedding_similarity:
-            human_scores.append(score_dict[word])
-            machine_similarities.append(embedding_similarity[word])
-
-    # Calculate the Spearman rank correlation coefficient
-    correlation, p_value = spearmanr(human_scores, machine_similarities)
-
-
-    return embedding_similarity, score_dict, correlation, p_value
+def spearman_correlation(dy1, dy2):
+    """
+    Calculate the Spearman rank correlation coefficient between human scores and semantic similarities.
+    Uses one EvaluationSession for the whole process.
+    """
+    global _session
+    if _session is None:
+        _session = EvaluationSession()
+    return _session.spearman_correlation(dy1, dy2)
 
 def dict2list(d):
     z=zip(d.values(),d.keys())
@@ -86,7 +142,7 @@ def dict2list(d):
     return new
 
 def top_shifted():
-    dys='Tang Song Yuan Ming Qing'.split()
+    dys=DYNASTIES
     comp=dys
 
     for d in dys:
@@ -106,7 +162,7 @@ def top_shifted():
 
 if __name__ == "__main__":
     top_shifted()
-    dynasties = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
+    dynasties = DYNASTIES
     for i in range(len(dynasties)):
         for j in range(i + 1, len(dynasties)):
             print(dynasties[i], dynasties[j])
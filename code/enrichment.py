@@ -0,0 +1,91 @@
+import os
+import pickle
+import pandas as pd
+import pypinyin
+from pypinyin import lazy_pinyin
+from config import *
+from utils import load_char_def, get_stroke_count, _UNIHAN_DICT_PATH
+from stage_cache import stage_key
+
+# Pinyin, stroke and gloss tables for batch annotation. They are built once from the
+# source files (pinyin for the whole CJK Unified Ideographs block) and kept in a
+# pickle, so later processes load them in milliseconds instead of re-parsing.
+CACHE_PATH = OUTPUT / 'enrichment.pkl'
+PREBUILT_RANGE = range(0x4e00, 0x9fff + 1)
+TABLES_VERSION = 1  # part of the cache key: bump when the tables are built differently
+
+_tables = None
+
+
+def _tables_key():
+    return stage_key(_UNIHAN_DICT_PATH, SOURCE / 'Unihan_Readings.txt', SOURCE / '全部汉字码表.TXT',
+                     pypinyin.__version__, TABLES_VERSION)
+
+
+def _batch_pinyin(chars):
+    # one lazy_pinyin call over a list: every item is read on its own, as get_pinyin does
+    chars = list(chars)
+    readings = lazy_pinyin(chars, style=pypinyin.TONE) if all(len(char) == 1 for char in chars) else []
+    if len(readings) != len(chars):
+        # an item giving more or fewer than one reading would shift every later one: convert one by one
+        readings = [' '.join(lazy_pinyin(char, style=pypinyin.TONE)) for char in chars]
+    return readings
+
+
+def load_tables():
+    """{'pinyin': {...}, 'strokes': {...}, 'gloss': {...}}, memoized in process and on disk."""
+    global _tables
+    if _tables is not None:
+        return _tables
+
+    key = _tables_key()
+    if CACHE_PATH.exists():
+        with open(CACHE_PATH, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['key'] == key:
+            _tables = cached
+            return _tables
+
+    chars = [chr(code) for code in PREBUILT_RANGE]
+    _tables = {
+        'key': key,
+        'pinyin': dict(zip(chars, _batch_pinyin(chars))),
+        'strokes': dict(get_stroke_count()),
+        'gloss': dict(load_char_def()),
+    }
+    _save()
+    return _tables
+
+
+def _save():
+    # written to a temporary file and renamed, so a process loading the tables never reads half a pickle
+    tmp = CACHE_PATH.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        pickle.dump(_tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, CACHE_PATH)
+
+
+def pinyin(chars):
+    """Tone-marked pinyin of each character; characters outside the prebuilt block are added to the cache."""
+    table = load_tables()['pinyin']
+    missing = list(dict.fromkeys(char for char in chars if char not in table))
+    if missing:
+        table.update(zip(missing, _batch_pinyin(missing)))
+        _save()
+    return [table[char] for char in chars]
+
+
+def annotate(chars):
+    """
+    Pinyin, stroke count and gloss of each character, with the defaults used in CAPLD.csv
+    (-1 strokes and '-' gloss when unknown).
+    :return: DataFrame indexed by character
+    """
+    chars = list(chars)
+    tables = load_tables()
+    strokes, gloss = tables['strokes'], tables['gloss']
+    return pd.DataFrame({
+        'Pinyin': pinyin(chars),
+        'Strokes': [strokes.get(char, -1) for char in chars],
+        'Gloss': [gloss.get(char, '-') for char in chars],
+    }, index=pd.Index(chars, name='Character'))
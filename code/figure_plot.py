@@ -3,13 +3,14 @@ import matplotlib.pyplot as plt
 import matplotlib.lines as lines
 plt.rcParams['font.sans-serif'] = ['SimHei']
 from utils import *
+from table_io import read_table
 plt.rcParams['axes.unicode_minus'] = False
 def get_fd():
     fd_path =ROOT.parent /'Diachronic_sub-database'/ 'time_series' / 'Diachronic_character_frequency_diversities.csv'
-    data=pd.read_csv(fd_path)
+    data=read_table(fd_path)
 
     fd_dict={}
-    columns=[f'{dy}_log_fd' for dy in 'Song Yuan Ming Qing'.split()]
+    columns=[f'{dy}_log_fd' for dy in DYNASTIES[1:]]
     for index,row in data.iterrows():
         word=row['Character']
         values=[row[col] for col in columns]
@@ -21,12 +22,12 @@ def get_fd():
 def get_entropy():
 
     entropy_path = ROOT.parent / 'Diachronic_sub-database'/'time_series'/ 'Diachronic_entropies.csv'
-    data=pd.read_csv(entropy_path)
+    data=read_table(entropy_path)
     left_dict={}
     right_dict={}
 
-    left_columns=[f'{dy}_left_entropy' for dy in 'Tang Song Yuan Ming Qing'.split()]
-    right_columns = [f'{dy}_right_entropy' for dy in 'Tang Song Yuan Ming Qing'.split()]
+    left_columns=[f'{dy}_left_entropy' for dy in DYNASTIES]
+    right_columns = [f'{dy}_right_entropy' for dy in DYNASTIES]
     for index,row in data.iterrows():
         word=row['Character']
         left_values=[row[col] for col in left_columns]
@@ -44,7 +45,7 @@ def ind_legend(words,pinyin,colors):
 
     return handles
 def plot_freq(ax, words,pinyin):
-    x = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
+    x = DYNASTIES
     colors = ['r', 'g', 'y', 'b']
     linestyle = 'solid'
     fd_dict=get_fd()
@@ -61,7 +62,7 @@ def plot_freq(ax, words,pinyin):
 def plot_entropy(ax, words,pinyin):
     colors = ['r', 'g', 'y', 'b']
 
-    x = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
+    x = DYNASTIES
 
     linestyles = ['solid', 'dashed']
     left_dict, right_dict = get_entropy()
@@ -77,17 +78,15 @@ def plot_entropy(ax, words,pinyin):
 
 
 def plot_similarity(ax, words,pinyin):
-    ts, _, _, _ = spearman_correlation('Tang', 'Song')
-    ty, _, _, _ = spearman_correlation('Tang', 'Yuan')
-    tm, _, _, _ = spearman_correlation('Tang', 'Ming')
-    tq, _, _, _ = spearman_correlation('Tang', 'Qing')
+    # the first period against each later one
+    sims = [spearman_correlation(DYNASTIES[0], dy)[0] for dy in DYNASTIES[1:]]
 
     colors = ['r', 'g', 'y', 'b']
 
-    x = ['Song', 'Yuan', 'Ming', 'Qing']
+    x = DYNASTIES[1:]
 
     for i, word in enumerate(words):
-        sim_list = [ts.get(word, 0),ty.get(word, 0),tm.get(word, 0),tq.get(word, 0)]
+        sim_list = [sim.get(word, 0) for sim in sims]
         print(word)
         print(sim_list)
         ax.plot(x, sim_list, label=pinyin[i], color=colors[i], linestyle='solid')
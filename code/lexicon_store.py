@@ -0,0 +1,142 @@
+import json
+import sqlite3
+import pandas as pd
+from config import *
+from stage_cache import stage_key, is_fresh, mark_done
+from table_io import read_table
+
+# Compiled, indexed copy of CAPLD.csv and the Diachronic_sub-database tables, so
+# services can answer per-character and range lookups without loading the CSVs.
+STORE_PATH = OUTPUT / 'lexicon.sqlite'
+STORE_VERSION = 1  # part of the stage key: bump when the schema changes
+
+_DATA = ROOT.parent / 'Diachronic_sub-database'
+TABLES = {
+    'capld': ROOT.parent / 'CAPLD.csv',
+    'frequencies': _DATA / 'Diachronic_data' / 'Diachronic_character_frequencies.csv',
+    'diversities': _DATA / 'Diachronic_data' / 'Diachronic_character_contextual_diversities.csv',
+    'phonology': _DATA / 'Diachronic_data' / 'Diachronic_Character_Phonology.csv',
+    'rhyme_positions': _DATA / 'Diachronic_data' / 'Diachronic_character_rhyme_positions.csv',
+    'frequency_diversities': _DATA / 'time_series' / 'Diachronic_character_frequency_diversities.csv',
+    'entropies': _DATA / 'time_series' / 'Diachronic_entropies.csv',
+    'similarities': _DATA / 'time_series' / 'Diachronic_character_similarities.csv',
+}
+
+# Columns indexed for range queries, besides Character
+INDEXED = {
+    'capld': ['Frequency', 'Frequency_per_million', 'CD', 'Strokes', 'PSY_Tone'],
+    'phonology': ['PSY_Tone', 'GY_Tone'],
+}
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def build_lexicon_store(path=STORE_PATH):
+    """Compile the CSV tables into an SQLite file; skipped while none of them changed."""
+    tables = {name: csv for name, csv in TABLES.items() if csv.exists()}
+    key = stage_key(str(path), *tables, *tables.values(), STORE_VERSION)
+    if is_fresh('lexicon_store', key, [path]):
+        return path
+
+    tmp = path.with_suffix('.tmp')
+    tmp.unlink(missing_ok=True)
+    con = sqlite3.connect(tmp)
+    records = {}
+    for name, csv in tables.items():
+        df = read_table(csv, encoding='utf-8-sig')
+        df = df[df['Character'].notna()]  # records is keyed on Character
+        df.to_sql(name, con, index=False)
+        unique = 'UNIQUE ' if df['Character'].is_unique else ''
+        con.execute(f'CREATE {unique}INDEX {name}_character ON {name} (Character)')
+        for column in INDEXED.get(name, []):
+            con.execute(f'CREATE INDEX {_quote(name + "_" + column)} ON {name} ({_quote(column)})')
+        for row in df.astype(object).where(df.notna(), None).to_dict('records'):
+            records.setdefault(row['Character'], {}).setdefault(name, row)
+
+    # The full record of each character in one row, for point lookups
+    con.execute('CREATE TABLE records (Character TEXT PRIMARY KEY, record TEXT) WITHOUT ROWID')
+    con.executemany('INSERT INTO records VALUES (?, ?)',
+                    ((char, json.dumps(record, ensure_ascii=False)) for char, record in records.items()))
+    con.commit()
+    con.close()
+    tmp.replace(path)
+    mark_done('lexicon_store', key)
+    print(f'Lexicon store saved to {path}')
+    return path
+
+
+class LexiconStore:
+    """
+    Read-only access to the compiled store.
+
+    >>> store = LexiconStore()
+    >>> store.lookup('人')['capld']['CD']
+    >>> store.query('capld', Frequency_per_million=(100, 1000), PSY_Tone='level')
+    """
+
+    def __init__(self, path=STORE_PATH):
+        self.con = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        self.tables = [row[0] for row in self.con.execute("SELECT name FROM sqlite_master WHERE type='table'")
+                       if row[0] != 'records']
+        self.columns = {table: [row[1] for row in self.con.execute(f'PRAGMA table_info({table})')]
+                        for table in self.tables}
+
+    def lookup(self, char):
+        """The full record of one character: {table: {column: value}} (None where absent)."""
+        row = self.con.execute('SELECT record FROM records WHERE Character = ?', (char,)).fetchone()
+        record = json.loads(row[0]) if row is not None else {}
+        return {table: record.get(table) for table in self.tables}
+
+    def query(self, table='capld', columns=None, where=None, order_by=None, limit=None, **conditions):
+        """
+        Rows of a table matching every condition, as a DataFrame.
+        A condition is a value (equality), a (low, high) tuple (inclusive range, None for
+        an open end) or a list (membership). Columns whose names are not valid keywords,
+        such as 'Tang&Song', go in `where`.
+        """
+        if table not in self.tables:
+            raise ValueError(f'No table {table!r}; the tables are {", ".join(self.tables)}')
+        for column in [*(columns or []), *([order_by] if order_by else [])]:
+            self._check_column(table, column)
+        conditions = {**(where or {}), **conditions}
+        clauses, params = [], []
+        for column, value in conditions.items():
+            self._check_column(table, column)
+            name = _quote(column)
+            if isinstance(value, tuple):
+                low, high = value
+                if low is not None:
+                    clauses.append(f'{name} >= ?')
+                    params.append(low)
+                if high is not None:
+                    clauses.append(f'{name} <= ?')
+                    params.append(high)
+            elif isinstance(value, list):
+                clauses.append(f'{name} IN ({", ".join("?" * len(value))})')
+                params.extend(value)
+            else:
+                clauses.append(f'{name} = ?')
+                params.append(value)
+
+        select = ', '.join(_quote(column) for column in columns) if columns else '*'
+        sql = f'SELECT {select} FROM {table}'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        if order_by:
+            sql += f' ORDER BY {_quote(order_by)}'
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+        return pd.read_sql_query(sql, self.con, params=params)
+
+    def _check_column(self, table, column):
+        if column not in self.columns[table]:
+            raise ValueError(f'{table} has no column {column!r}; its columns are {", ".join(self.columns[table])}')
+
+    def close(self):
+        self.con.close()
+
+
+if __name__ == "__main__":
+    build_lexicon_store()
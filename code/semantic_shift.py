@@ -0,0 +1,100 @@
+import argparse
+import numpy as np
+import pandas as pd
+from config import *
+from embedding_alignment import aligned_embeddings
+
+# Nearest neighbors and neighborhood shift of characters across dynasties, over the aligned
+# matrices of align_embedding_space (all in one shared space, rows in the same character order).
+# Every matrix is row-normalized to float32 once, so a batch of queries is one matrix
+# product per block of rows followed by an argpartition top-k.
+BLOCK = 1024  # query rows per matrix product, bounding the n x vocabulary similarity block
+
+
+class ShiftQueryEngine:
+    """
+    >>> engine = ShiftQueryEngine()
+    >>> engine.neighbors(['心', '月'], 'Song', k=5)
+    >>> engine.neighbors(['心'], 'Song', target='Qing')
+    >>> engine.shift(['心', '月'], 'Song', 'Qing', k=10)
+    """
+
+    def __init__(self, dynasties=tuple(DYNASTIES)):
+        aligned, self.vocab = aligned_embeddings(dynasties)
+        self.index = {char: i for i, char in enumerate(self.vocab)}
+        self.normalized = {}
+        for dy, matrix in aligned.items():
+            matrix = np.asarray(matrix, dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            self.normalized[dy] = matrix / np.where(norms == 0, 1, norms)
+
+    def ids(self, chars):
+        missing = [char for char in chars if char not in self.index]
+        if missing:
+            raise KeyError(f'not in the aligned vocabulary: {"".join(missing)}')
+        return np.array([self.index[char] for char in chars], dtype=np.int64)
+
+    def top_k(self, ids, dy, k=10, target=None):
+        """
+        The k nearest rows of `target` (default: dy itself, the query excluded) to the
+        rows `ids` of dy, by cosine similarity.
+        :return: (neighbor ids, similarities), both of shape len(ids) x k, best first
+        """
+        queries = self.normalized[dy]
+        candidates = self.normalized[target or dy]
+        exclude_self = target is None or target == dy
+        k = min(k, len(self.vocab) - exclude_self)
+        neighbors = np.empty((len(ids), k), dtype=np.int64)
+        similarities = np.empty((len(ids), k), dtype=np.float32)
+        for start in range(0, len(ids), BLOCK):
+            block = ids[start:start + BLOCK]
+            rows = np.arange(len(block))
+            sims = queries[block] @ candidates.T
+            if exclude_self:
+                sims[rows, block] = -np.inf
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            order = np.argsort(-sims[rows[:, None], top], axis=1, kind='stable')
+            top = top[rows[:, None], order]
+            neighbors[start:start + len(block)] = top
+            similarities[start:start + len(block)] = sims[rows[:, None], top]
+        return neighbors, similarities
+
+    def neighbors(self, chars, dy, k=10, target=None):
+        """
+        Nearest neighbors of each character in dy, or with `target` the nearest characters
+        of another dynasty to its dy vector (the character itself included).
+        :return: {char: [(neighbor, similarity), ...]}, as gensim's most_similar
+        """
+        neighbors, similarities = self.top_k(self.ids(chars), dy, k, target)
+        return {char: [(self.vocab[j], float(sim)) for j, sim in zip(row, sims)]
+                for char, row, sims in zip(chars, neighbors.tolist(), similarities.tolist())}
+
+    def shift(self, chars, dy1, dy2, k=10):
+        """
+        How much each character moved between two dynasties.
+        :return: DataFrame with the cosine similarity of its two aligned vectors, the share
+                 of its k nearest neighbors found in both dynasties, and shift = 1 - overlap
+        """
+        ids = self.ids(chars)
+        neighbors1, _ = self.top_k(ids, dy1, k)
+        neighbors2, _ = self.top_k(ids, dy2, k)
+        shared = (neighbors1[:, :, None] == neighbors2[:, None, :]).any(axis=2).sum(axis=1)
+        overlap = shared / neighbors1.shape[1]
+        cosine = np.einsum('ij,ij->i', self.normalized[dy1][ids], self.normalized[dy2][ids])
+        return pd.DataFrame({'Character': list(chars), f'{dy1}&{dy2}': cosine,
+                             'overlap': overlap, 'shift': 1 - overlap})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('chars', help='characters to query, e.g. 心月')
+    parser.add_argument('--dynasties', nargs=2, default=[DYNASTIES[0], DYNASTIES[-1]], help='the two dynasties compared')
+    parser.add_argument('-k', type=int, default=10, help='number of neighbors')
+    args = parser.parse_args()
+    engine = ShiftQueryEngine()
+    chars = list(args.chars)
+    dy1, dy2 = args.dynasties
+    for dy in (dy1, dy2):
+        for char, neighbors in engine.neighbors(chars, dy, args.k).items():
+            print(dy, char, ' '.join(f'{neighbor}({similarity:.3f})' for neighbor, similarity in neighbors))
+    print(engine.shift(chars, dy1, dy2, args.k).to_string(index=False))
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import pickle
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from config import *
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# Every intermediate of the build is recorded under a key hashed from its inputs
+# (content digests of the files it reads plus its parameters, and the version of the
+# code that derives it). A stage whose key is unchanged and whose outputs still exist
+# is skipped. Delete this folder to force a full rebuild.
+# The index files are shared by the processes of a parallel build: they are read and
+# rewritten under a lock file, and replaced atomically so a reader never sees half a file.
+CACHE = OUTPUT / 'cache'
+CACHE.mkdir(exist_ok=True)
+_DIGESTS = CACHE / 'digests.json'
+_STAGES = CACHE / 'stages.json'
+_LOCK = CACHE / 'index.lock'
+
+
+@contextmanager
+def _locked():
+    with open(_LOCK, 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:  # LK_LOCK gives up after 10 seconds
+                    time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _load_json(path):
+    with _locked():
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    return {}
+
+
+def _update_json(path, name, value):
+    """Set one entry of an index file, re-reading it under the lock so no other writer's entry is lost."""
+    with _locked():
+        data = {}
+        if path.exists():
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        data[name] = value
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+def file_digest(path):
+    """
+    Content hash of a file. Digests are remembered by size and modification time,
+    so a multi-GB corpus is only re-hashed after it changes.
+    """
+    path = Path(path)
+    stat = path.stat()
+    stamp = f'{stat.st_size}:{stat.st_mtime_ns}'
+    entry = _load_json(_DIGESTS).get(str(path))
+    if entry and entry['stamp'] == stamp:
+        return entry['digest']
+
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    _update_json(_DIGESTS, str(path), {'stamp': stamp, 'digest': h.hexdigest()})
+    return h.hexdigest()
+
+
+def remember_digest(path, digest):
+    """Record the digest of a file its writer already hashed, so it is not read again."""
+    path = Path(path)
+    stat = path.stat()
+    _update_json(_DIGESTS, str(path), {'stamp': f'{stat.st_size}:{stat.st_mtime_ns}', 'digest': digest})
+
+
+def stage_key(*parts):
+    """Key of a stage: paths contribute the digest of their content, other parts their repr."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, Path):
+            part = file_digest(part) if part.exists() else 'missing'
+        h.update(repr(part).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def is_fresh(stage, key, outputs=()):
+    return _load_json(_STAGES).get(stage) == key and all(Path(p).exists() for p in outputs)
+
+
+def mark_done(stage, key):
+    _update_json(_STAGES, stage, key)
+
+
+def has_result(stage, key, outputs=()):
+    """Whether load_result would return the result, without unpickling it."""
+    return is_fresh(stage, key, [CACHE / f'{stage}.pkl', *outputs])
+
+
+def load_result(stage, key, outputs=()):
+    """The pickled result of a stage, or None when its inputs changed."""
+    path = CACHE / f'{stage}.pkl'
+    if not has_result(stage, key, outputs):
+        return None
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_result(stage, key, result):
+    path = CACHE / f'{stage}.pkl'
+    tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+    with open(tmp, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    mark_done(stage, key)
+
+
+def cached(stage, key, compute):
+    result = load_result(stage, key)
+    if result is None:
+        result = compute()
+        save_result(stage, key, result)
+    return result
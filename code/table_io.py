@@ -0,0 +1,166 @@
+import io
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from config import *
+
+# Columnar copies of the corpora and tables. Every CSV the build writes through
+# write_table gets a Parquet sibling (same name, .parquet) when pyarrow is installed,
+# and readers take the Parquet file while it is not older than the CSV, reading only
+# the columns they use. Without pyarrow everything stays on CSV.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+def columnar_path(path):
+    return Path(path).with_suffix('.parquet')
+
+
+def has_columnar(path):
+    """Whether the Parquet copy of a CSV can be read in its place."""
+    if pq is None:
+        return False
+    path, columnar = Path(path), columnar_path(path)
+    if not columnar.exists():
+        return False
+    return not path.exists() or columnar.stat().st_mtime_ns >= path.stat().st_mtime_ns
+
+
+def source_path(path):
+    """The file a reader of `path` actually opens: its Parquet copy or the CSV itself."""
+    return columnar_path(path) if has_columnar(path) else Path(path)
+
+
+def write_table(df, path, **csv_kwargs):
+    """df.to_csv(path, **csv_kwargs), plus the Parquet copy with the same rows and columns."""
+    df.to_csv(path, **csv_kwargs)
+    if pq is None:
+        return
+    if csv_kwargs.get('index', True):
+        df = df.rename_axis(csv_kwargs.get('index_label') or df.index.name).reset_index()
+    df.to_parquet(columnar_path(path), index=False)
+
+
+def read_table(path, columns=None, **csv_kwargs):
+    """A table written by write_table, restricted to `columns` (all when None)."""
+    if has_columnar(path):
+        return pd.read_parquet(columnar_path(path), columns=columns)
+    df = pd.read_csv(path, usecols=columns, **csv_kwargs)
+    return df if columns is None else df[columns]
+
+
+def row_group_starts(path):
+    """The data row at which every row group of the Parquet copy starts, and the row count at the end."""
+    metadata = pq.ParquetFile(columnar_path(path)).metadata
+    rows = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+    return np.concatenate([[0], np.cumsum(rows, dtype=np.int64)])
+
+
+def csv_row_offsets(path, block=1 << 24):
+    """
+    Byte offset of every data row of a CSV and of the end of the file, from one pass over its
+    bytes: a row ends at a newline preceded by an even number of quotes, so quoted fields may
+    span lines. Quotes are counted modulo 256, which keeps their parity.
+    """
+    ends, quotes, position = [], 0, 0
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(block), b''):
+            data = np.frombuffer(data, dtype=np.uint8)
+            parity = np.cumsum(data == ord('"'), dtype=np.uint8) + np.uint8(quotes)
+            ends.append(np.flatnonzero((data == ord('\n')) & (parity & 1 == 0)) + position + 1)
+            quotes, position = int(parity[-1]), position + len(data)
+    ends = np.concatenate(ends) if ends else np.zeros(0, dtype=np.int64)
+    if not len(ends) or ends[-1] != position:
+        ends = np.append(ends, position)  # the last row has no newline
+    return ends
+
+
+class _CsvRange(io.RawIOBase):
+    """The header row of a CSV followed by the rows in the bytes [begin, end), read lazily."""
+
+    def __init__(self, path, header_end, begin, end):
+        self._file = open(path, 'rb')
+        self._parts = [[0, header_end], [begin, end]]
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self._parts and self._parts[0][0] >= self._parts[0][1]:
+            self._parts.pop(0)
+        if not self._parts:
+            return 0
+        part = self._parts[0]
+        self._file.seek(part[0])
+        n = self._file.readinto(memoryview(buffer)[:part[1] - part[0]])
+        part[0] += n
+        return n
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def csv_byte_range(offsets, start, stop):
+    """The byte_range of iter_column for the data rows [start, stop), from csv_row_offsets."""
+    return int(offsets[0]), int(offsets[start]), int(offsets[stop])
+
+
+def iter_column(path, column, chunksize, start=0, stop=None, byte_range=None):
+    """
+    Values of one column as lists of at most `chunksize` items, for the data rows [start, stop).
+    From Parquet only the row groups overlapping the range are decoded. From CSV the rows are
+    read from their bytes only: `byte_range` is (end of the header, first byte, end byte) as
+    given by csv_byte_range, and is found with one pass over the file when not given.
+    """
+    if not has_columnar(path):
+        if byte_range is None and (start or stop is not None):
+            offsets = csv_row_offsets(path)
+            stop = len(offsets) - 1 if stop is None else min(stop, len(offsets) - 1)
+            byte_range = csv_byte_range(offsets, min(start, stop), stop)
+        if byte_range is not None and byte_range[1] >= byte_range[2]:
+            return
+        source = path if byte_range is None else io.BufferedReader(_CsvRange(path, *byte_range))
+        with pd.read_csv(source, usecols=[column], chunksize=chunksize, encoding='utf-8') as reader:
+            for df in reader:
+                yield df[column].tolist()
+        return
+
+    parquet = pq.ParquetFile(columnar_path(path))
+    metadata = parquet.metadata
+    stop = metadata.num_rows if stop is None else min(stop, metadata.num_rows)
+    groups, offset, first = [], 0, None
+    for i in range(metadata.num_row_groups):
+        rows = metadata.row_group(i).num_rows
+        if offset < stop and offset + rows > start:
+            groups.append(i)
+            first = offset if first is None else first
+        offset += rows
+    if not groups:
+        return
+    position = first
+    for batch in parquet.iter_batches(batch_size=chunksize, row_groups=groups, columns=[column]):
+        lo, hi = max(start - position, 0), min(stop - position, batch.num_rows)
+        position += batch.num_rows
+        if lo < hi:
+            yield batch.column(0).slice(lo, hi - lo).to_pylist()
+        if position >= stop:
+            return
+
+
+def corpus_writer(path, columns):
+    """A ParquetWriter for a corpus streamed in chunks (all columns as strings), or None without pyarrow."""
+    if pq is None:
+        return None
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    return pq.ParquetWriter(columnar_path(path), schema)
+
+
+def write_corpus_chunk(writer, df):
+    """Append a chunk already reindexed to the writer's columns; values are kept as their CSV text."""
+    data = {column: [None if pd.isna(value) else str(value) for value in df[column].tolist()]
+            for column in writer.schema.names}
+    writer.write_table(pa.table(data, schema=writer.schema))
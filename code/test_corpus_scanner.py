@@ -0,0 +1,155 @@
+import numpy as np
+import pandas as pd
+import pytest
+import corpus_scanner
+import stage_cache
+from corpus_scanner import (Chunk, PositionAccumulator, TrigramAccumulator, WindowAccumulator, encode_texts,
+                            line_spans)
+from table_io import columnar_path, csv_byte_range, source_path, pa, pq
+
+# The □ stands for an illegible character: it belongs to its line like any other
+POEM = '白日依山尽，黄河入海流。欲穷千□目，更上一层楼。'
+
+
+def scanned(accumulator, texts):
+    accumulator.update(Chunk(texts))
+    return accumulator
+
+
+def test_lines_keep_other_characters():
+    codes, offsets = encode_texts([POEM, '床前明月光、疑是地上霜'])
+    spans, numbers = line_spans(codes, offsets)
+    text = POEM + '床前明月光、疑是地上霜'
+    assert [text[start:end] for start, end in spans.tolist()] == \
+           ['白日依山尽', '黄河入海流', '欲穷千□目', '更上一层楼', '床前明月光', '疑是地上霜']
+    assert numbers.tolist() == [0, 1, 2, 3, 0, 1]
+
+
+def test_lines_without_chinese_are_dropped():
+    codes, offsets = encode_texts(['nan', '□□，白日依山尽。'])
+    spans, numbers = line_spans(codes, offsets)
+    assert spans.tolist() == [[6, 11]]
+    assert numbers.tolist() == [0]
+
+
+def test_rhyme_position():
+    positions = scanned(PositionAccumulator(), [POEM])
+    assert positions.count(['楼', '流', '目', '尽']).tolist() == [1, 1, 0, 0]
+    assert positions.count(['目', '尽', '千'], 'line_end').tolist() == [1, 1, 0]
+    assert positions.count(['目'], 4).tolist() == [1]  # the □ keeps its place in the line
+
+
+def test_rhyme_on_placeholder_is_not_counted():
+    positions = scanned(PositionAccumulator(), ['白日依山尽，黄河入海□。'])
+    assert positions.rhyme.sum() == 0
+    assert positions.line_end.sum() == 1
+
+
+def test_collocations_skip_placeholder():
+    window = scanned(WindowAccumulator(1), [POEM])
+    assert window.submatrix(['千', '目']).toarray().tolist() == [[0, 0], [0, 0]]
+    window = scanned(WindowAccumulator(2), [POEM])
+    assert window.submatrix(['千', '目']).toarray().tolist() == [[0, 1], [1, 0]]
+
+    trigrams = dict(scanned(TrigramAccumulator(), [POEM]).most_common())
+    assert trigrams['欲穷千'] == 1
+    assert not any('□' in trigram or trigram in ('穷千目', '千目更') for trigram in trigrams)
+    assert sum(trigrams.values()) == 3 + 3 + 1 + 3
+
+
+# Serial, sharded and encoded scans must give the same counts (the shards of scan_dynasties
+# are the scan_shard tasks below, run here in-process and merged in row order).
+KINDS = ['frequency', 'window2', 'trigram']
+CHARACTERS = list('白日依山尽黄河入海流欲穷千里目更上一层楼床前明月光疑是地上霜□')
+
+
+def corpus_poems(n=60, seed=0):
+    rng = np.random.default_rng(seed)
+    poems = []
+    for _ in range(n):
+        lines = [''.join(rng.choice(CHARACTERS, rng.integers(4, 8))) for _ in range(2 * rng.integers(1, 5))]
+        poems.append(''.join(line + '，。'[i % 2] for i, line in enumerate(lines)))
+    poems[3] = None  # a missing poem
+    poems[5] = '白日"依山"尽，\n黄河入海流。'  # quotes and a newline inside a CSV field
+    return poems
+
+
+@pytest.fixture
+def corpus(tmp_path, monkeypatch):
+    """A Tang corpus of its own, with the stage cache and the token arrays under tmp_path."""
+    monkeypatch.setattr(stage_cache, 'CACHE', tmp_path)
+    monkeypatch.setattr(stage_cache, '_DIGESTS', tmp_path / 'digests.json')
+    monkeypatch.setattr(stage_cache, '_STAGES', tmp_path / 'stages.json')
+    monkeypatch.setattr(stage_cache, '_LOCK', tmp_path / 'index.lock')
+    monkeypatch.setattr(corpus_scanner, 'TOKENS', tmp_path / 'tokens')
+    path = tmp_path / 'Tang.csv'
+    poems = corpus_poems()
+    pd.DataFrame({'作者': [f'诗人{i}' for i in range(len(poems))], '内容': poems}).to_csv(path, index=False)
+    monkeypatch.setattr(corpus_scanner, 'dynasty_path', lambda dy: source_path(path))
+    return path
+
+
+def sharded(encoded, shards=4):
+    rows, cuts, offsets = corpus_scanner.shard_plan('Tang', encoded)
+    merged = [corpus_scanner.new_accumulator(kind) for kind in KINDS]
+    for start, stop in corpus_scanner.shard_ranges(rows, -(-rows // shards), cuts):
+        byte_range = None if offsets is None else csv_byte_range(offsets, start, stop)
+        for accumulator, partial in zip(merged, corpus_scanner.scan_shard('Tang', KINDS, start, stop, encoded,
+                                                                          byte_range)):
+            accumulator.merge(partial)
+    return merged
+
+
+def chunked(chunks):
+    accumulators = [corpus_scanner.new_accumulator(kind) for kind in KINDS]
+    for chunk in chunks:
+        for accumulator in accumulators:
+            accumulator.update(chunk)
+    return accumulators
+
+
+def assert_same(expected, actual):
+    frequency, window, trigram = expected
+    assert list(actual[0].counts.items()) == list(frequency.counts.items())
+    assert (actual[1].table() != window.table()).nnz == 0
+    for expected_array, actual_array in zip(trigram.table(), actual[2].table()):
+        assert np.array_equal(expected_array, actual_array)
+
+
+def test_csv_shards_match_serial_scan(corpus):
+    serial = corpus_scanner.scan_shard('Tang', KINDS, 0, None)
+    assert serial[0].counts['白'] > 0 and serial[2].table()[0].size > 0
+    assert_same(serial, sharded(False))
+    assert_same(serial, chunked(corpus_scanner.iter_chunks(corpus, chunksize=7)))
+
+
+def test_encoded_scans_match_csv_scan(corpus):
+    serial = corpus_scanner.scan_shard('Tang', KINDS, 0, None)
+    corpus_scanner.encode_corpora(['Tang'], chunksize=7)
+    assert_same(serial, corpus_scanner.scan_shard('Tang', KINDS, 0, None, encoded=True))
+    assert_same(serial, sharded(True))
+    assert_same(serial, chunked(corpus_scanner.TokenCorpus('Tang').chunks(chunksize=7)))
+
+
+@pytest.mark.skipif(pq is None, reason='pyarrow is not installed')
+def test_parquet_shards_match_csv_scan(corpus):
+    serial = corpus_scanner.scan_shard('Tang', KINDS, 0, None)
+    pq.write_table(pa.Table.from_pandas(pd.read_csv(corpus, dtype=str), preserve_index=False),
+                   columnar_path(corpus), row_group_size=16)
+    assert corpus_scanner.dynasty_path('Tang').suffix == '.parquet'
+    assert_same(serial, corpus_scanner.scan_shard('Tang', KINDS, 0, None))
+    assert_same(serial, sharded(False))
+
+
+def test_content_diversity_shards_count_duplicates_once():
+    poems = corpus_poems(40)
+    poems = poems + poems[::3]  # every third poem again, in another shard
+    serial = corpus_scanner.new_accumulator('content_diversity')
+    serial.update(Chunk(['nan' if poem is None else poem for poem in poems]))
+    merged = corpus_scanner.new_accumulator('content_diversity')
+    for start in range(0, len(poems), 11):
+        partial = corpus_scanner.new_accumulator('content_diversity')
+        partial.update(Chunk(['nan' if poem is None else poem for poem in poems[start:start + 11]]))
+        merged.merge(partial)
+    assert serial.count(['白']).tolist() == [sum('白' in poem for poem in set(poems) - {None})]
+    assert np.array_equal(merged.poems, serial.poems)
@@ -4,6 +4,13 @@ from collections import defaultdict
 import string
 from config import *
 from embedding_alignment import *
+from corpus_scanner import scan_dynasty, scan_dynasties, period_paths, chinese_ids, NeighborAccumulator
+from scipy import sparse
+from stage_cache import stage_key, load_result, save_result
+from table_io import write_table, read_table
+import argparse
+
+ENTROPY_VERSION = 1  # part of the stage key of the cached entropies: bump when their computation changes
 
 def calculate_entropy(frequencies):
     # Function to calculate entropy given a dictionary of frequencies
@@ -11,59 +18,64 @@ def calculate_entropy(frequencies):
     entropy = -sum((freq / total) * math.log2(freq / total) for freq in frequencies.values() if freq > 0)
     return entropy
 
-def generate_Entropy():
+def row_entropy(counts):
+    """
+    Entropy (bits) of every row of a sparse count matrix, 0 for empty rows.
+    """
+    counts = sparse.csr_matrix(counts, dtype=np.float64)
+    counts.eliminate_zeros()
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    p = counts.data / totals[rows]
+    return -np.bincount(rows, weights=p * np.log2(p), minlength=counts.shape[0])
+
+def generate_Entropy(jobs=1):
     # Function to calculate left and right entropies for each character in each dynasty and combine them into CSV files
-    dynasties = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
-    punctuation_and_space = string.punctuation + ' ' + '，。！？；：（）【】《》“”‘’——……'
+    dynasties = DYNASTIES
     freq_df_path= ROOT.parent /'Diachronic_sub-database'/ 'Diachronic_data' / 'Diachronic_character_frequencies.csv'
-    vocab_df = pd.read_csv(freq_df_path)
+    vocab_df = read_table(freq_df_path, ['Character', 'pinyin', 'Gloss'])
     characters = vocab_df["Character"].tolist()
     entropy_df=pd.DataFrame({'Character':characters})
     entropy_df['pinyin']=vocab_df['pinyin']
     entropy_df['Gloss']=vocab_df['Gloss']
+
+    # the entropy columns of a dynasty are reused while its corpus and the character list are unchanged
+    keys = {dy: stage_key(*period_paths(dy), freq_df_path, NeighborAccumulator.version, ENTROPY_VERSION)
+            for dy in dynasties}
+    cached = {dy: load_result(f'entropy_{dy}', keys[dy]) for dy in dynasties}
+    scan_dynasties([dy for dy in dynasties if cached[dy] is None], ['neighbor'], jobs)
     for dy in dynasties:
-        left_neighbors = defaultdict(lambda: defaultdict(int))
-        right_neighbors = defaultdict(lambda: defaultdict(int))
-        dir_path =  CORPUS / 'dynasty_corpus'/ f'{dy}.csv'
-        each_dy_poems = pd.read_csv(dir_path)
-        for _, row in each_dy_poems.iterrows():
-            text = str(row["内容"])
-
-            for i in range(1, len(text) - 1):
-                char = text[i]
-                if char in characters:
-                    if text[i - 1] not in punctuation_and_space:
-                        left_neighbors[char][text[i - 1]] = left_neighbors[char].get(text[i - 1], 0) + 1
-                    if text[i + 1] not in punctuation_and_space:
-                        right_neighbors[char][text[i + 1]] = right_neighbors[char].get(text[i + 1], 0) + 1
-        dy_left_entropy=[]
-        dy_right_entropy=[]
-
-        for i, char in enumerate(characters):
-            left_entropy = calculate_entropy(left_neighbors[char])
-            right_entropy = calculate_entropy(right_neighbors[char])
-            dy_left_entropy.append(left_entropy)
-            dy_right_entropy.append(right_entropy)
+        if cached[dy] is not None:
+            dy_left_entropy, dy_right_entropy = cached[dy]
+            entropy_df[fr'{dy}_left_entropy']=dy_left_entropy
+            entropy_df[fr'{dy}_right_entropy'] = dy_right_entropy
+            continue
+        # neighbor count matrices are collected for every Chinese character by the corpus scanner
+        neighbors = scan_dynasty(dy, ['neighbor'])['neighbor']
+        rows = chinese_ids(characters)
+        dy_left_entropy = row_entropy(neighbors.left[rows])
+        dy_right_entropy = row_entropy(neighbors.right[rows])
+        save_result(f'entropy_{dy}', keys[dy], (dy_left_entropy, dy_right_entropy))
         entropy_df[fr'{dy}_left_entropy']=dy_left_entropy
         entropy_df[fr'{dy}_right_entropy'] = dy_right_entropy
 
     save_path=ROOT.parent /'Diachronic_sub-database'/ 'time_series' /'Diachronic_entropies.csv'
-    entropy_df.to_csv( save_path , index=False)
+    write_table(entropy_df, save_path, index=False)
     print(f"Entropy data has been saved to {save_path}")
 
 
 def generate_frequency_diversity():
     # Define the list of dynasties
-    dynasties = ['Tang', 'Song', 'Yuan', 'Ming', 'Qing']
+    dynasties = DYNASTIES
     # Load the frequency data
     input_file = ROOT.parent /'Diachronic_sub-database'/ 'Diachronic_data' /'Diachronic_character_frequencies.csv'
     if not os.path.exists(input_file):
         print(f"Input file not found: {input_file}")
         return
-    df = pd.read_csv(input_file)
+    df = read_table(input_file, ['Character'] + [f'PerMillion_{dy}' for dy in dynasties])
     # Initialize columns for frequency diversity and log frequency diversity
-    for dy in dynasties[1:]:  # Skip Tang dynasty as it is the reference
-        df[f'{dy}_fd'] = df[f'PerMillion_{dy}'] / df['PerMillion_Tang']
+    for dy in dynasties[1:]:  # Skip the first period (Tang) as it is the reference
+        df[f'{dy}_fd'] = df[f'PerMillion_{dy}'] / df[f'PerMillion_{dynasties[0]}']
         df[f'{dy}_log_fd'] = np.log10(df[f'{dy}_fd'])
     # Select and reorder the columns as specified
 
@@ -75,45 +87,57 @@ def generate_frequency_diversity():
         os.makedirs(output_dir)
     # Save the results to a new CSV file
     output_file = os.path.join(output_dir, 'Diachronic_character_frequency_diversities.csv')
-    df.to_csv(output_file, index=False)
+    write_table(df, output_file, index=False)
     print(f"Frequency diversity data has been saved to {output_file}")
 
-def generate_dynasty_cosine_similarity():
-    aligned_matrices,common_vocab,models=align_embedding_space()
-    # Get the first matrix as the base matrix
-    base_matrix = aligned_matrices[0]
-    other_matrices = aligned_matrices[1:]
-
-    # Initialize the result list
-    results = []
-
-    # Iterate through each word in the common vocabulary
-    for idx, word in enumerate(common_vocab):
-        # Get the vector of the current word in the base matrix
-        base_vector = base_matrix[idx].reshape(1, -1)
-
-        # Calculate the cosine similarity with the corresponding word vectors in other matrices
-        similarities = []
-        for matrix in other_matrices:
-            other_vector = matrix[idx].reshape(1, -1)
-            similarity = cosine_similarity(base_vector, other_vector)[0][0]
-            similarities.append(similarity)
-
-        # Append the result to the list
-        results.append([word] + similarities)
-
-    # Create a DataFrame
-
-    columns = ['Character', 'Tang&Song', 'Tang&Yuan', 'Tang&Ming', 'Tang&Qing']
-    df = pd.DataFrame(results, columns=columns)
-
-    # Save to a CSV file
-
-    save_path=ROOT.parent / 'Diachronic_sub-database'/'time_series'/'Diachronic_character_similarities.csv'
-    df.to_csv(save_path, index=False)
-    print("Cosine similarity results have been saved to 'Diachronic_character_similarities.csv'.")
+def normalize_rows(matrix):
+    """The rows of a matrix scaled to unit length; a zero row stays zero (similarity 0, as in sklearn)."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def dynasty_similarities(aligned, reference=DYNASTIES[0], pairwise=False):
+    """
+    Cosine similarity of every character between dynasties, as one row-wise dot product of
+    the row-normalized aligned matrices per pair.
+    :param aligned: {dynasty: aligned matrix}, rows in the same character order
+    :param reference: The dynasty compared with every other one
+    :param pairwise: Compare every pair of dynasties instead
+    :return: {'Tang&Song': similarities, ...} in dynasty order
+    """
+    dynasties = list(aligned)
+    normalized = {dy: normalize_rows(matrix) for dy, matrix in aligned.items()}
+    if pairwise:
+        pairs = [(a, b) for i, a in enumerate(dynasties) for b in dynasties[i + 1:]]
+    else:
+        pairs = [(reference, dy) for dy in dynasties if dy != reference]
+    return {f'{a}&{b}': np.einsum('ij,ij->i', normalized[a], normalized[b]) for a, b in pairs}
+
+
+def generate_dynasty_cosine_similarity(reference=DYNASTIES[0], pairwise=False):
+    dynasties = DYNASTIES
+    # the aligned matrices saved by align_embedding_space are memory-mapped; align only when they are missing or stale
+    aligned, common_vocab = aligned_embeddings(dynasties)
+    similarities = dynasty_similarities(aligned, reference, pairwise)
+
+    # Create a DataFrame: one row per character, one column per dynasty pair
+    df = pd.DataFrame({'Character': common_vocab, **similarities})
+
+    # Save to a CSV file; other comparisons than the first period with each other one get their own file
+    name = 'Diachronic_character_similarities'
+    if pairwise:
+        name += '_pairwise'
+    elif reference != dynasties[0]:
+        name += f'_{reference}'
+    save_path=ROOT.parent / 'Diachronic_sub-database'/'time_series'/f'{name}.csv'
+    write_table(df, save_path, index=False)
+    print(f"Cosine similarity results have been saved to '{name}.csv'.")
 
 if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reference', default=DYNASTIES[0], help='dynasty the others are compared with')
+    parser.add_argument('--pairwise', action='store_true', help='compare every pair of dynasties')
+    args = parser.parse_args()
     # generate_Entropy()
     # generate_frequency_diversity()
-    generate_dynasty_cosine_similarity()
\ No newline at end of file
+    generate_dynasty_cosine_similarity(args.reference, args.pairwise)
\ No newline at end of file
@@ -1,10 +1,14 @@
 import pandas as pd
-import os, re, json, urllib.request, zipfile, io
+import os, re, json, urllib.request, zipfile, io, hashlib
 import pypinyin
 from pypinyin import lazy_pinyin
 from opencc import OpenCC
 from config import *
 from collections import defaultdict
+from functools import lru_cache
+from stage_cache import file_digest, remember_digest
+from corpus_scanner import CHUNKSIZE, MANIFEST_NAME
+from table_io import corpus_writer, write_corpus_chunk, columnar_path
 cc=OpenCC('t2s')
 _UNIHAN_DICT_PATH =SOURCE/ 'unihan_def.json'
 
@@ -13,6 +17,7 @@ def get_pinyin(char: str) -> str:
     """Returns the pinyin for a singl e Chinese character or multiple characters, with tone numbers."""
     return " ".join(lazy_pinyin(char, style=pypinyin.TONE))
 
+@lru_cache(maxsize=None)
 def load_char_def(cache_path=_UNIHAN_DICT_PATH):
     # =============================================================================
     # Character Translation (Chinese–English mapping)
@@ -43,7 +48,7 @@ def load_char_def(cache_path=_UNIHAN_DICT_PATH):
                 char_def[char] = defn
 
     with open(cache_path, 'w', encoding='utf-8') as f:
-        json.dump(char_def, f, ensure_ascii=False, indent=0)
+        json.dump(char_def, f, ensure_ascii=False, separators=(',', ':'))
     return char_def
 
 
@@ -164,6 +169,7 @@ def pingshui_dict():
     return CHAR_MAP
 
 
+@lru_cache(maxsize=None)
 def get_stroke_count():
     """
     Retrieve the stroke count of a given Chinese character from a specified text file.
@@ -180,8 +186,8 @@ def get_stroke_count():
     # 2. Place the file under the local path: `data/strokes/全部汉字码表.TXT`
     # 3. The script will read this file to extract stroke counts for characters.
     stroke_file = ROOT / 'source' / '全部汉字码表.TXT'
-    stroke_file=open(stroke_file, 'r', encoding='gb18030')
-    lines=stroke_file.readlines()
+    with open(stroke_file, 'r', encoding='gb18030') as f:
+        lines=f.readlines()
 
     stroke_dict={}
     for line in lines[6:]:
@@ -195,53 +201,104 @@ def get_stroke_count():
     return stroke_dict
 
 
-def get_dynasty_corpus():
+def slice_authors(name):
+    """The authors a slice is restricted to (config.SLICES), or None when it takes every poem."""
+    path = SLICES[name].get('authors')
+    if path is None:
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def slice_rows(df, authors, earlier):
+    """
+    Which poems of a raw file chunk go to a slice: those of its authors (all when None) that
+    no earlier slice reading the same file took. `earlier` are the author sets of those slices.
+    """
+    keep = pd.Series(True, index=df.index) if authors is None else df['作者'].isin(authors)
+    for other in earlier:
+        if other is None:
+            return pd.Series(False, index=df.index)
+        keep &= ~df['作者'].isin(other)
+    return keep
+
+
+def get_dynasty_corpus(chunksize=CHUNKSIZE):
+    """
+    Merge the raw corpus files into one CSV per slice. Each raw file is streamed in
+    chunks and appended to its dynasty, so memory stays bounded by the chunk size.
+    A manifest with the row count and content digest of every source and output file
+    is written next to the dynasty files.
+    """
     folder_path = CORPUS / 'raw_corpus'
     output_path = CORPUS / 'dynasty_corpus'
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    dynasty_map = {
-        '唐': 'Tang',
-        '宋': 'Song',
-        '元': 'Yuan',
-        '明': 'Ming',
-        '清': 'Qing',
-        '辽': 'Song',
-        '金': 'Song'
-    }
-
-    dynasty_data = {
-        'Tang': pd.DataFrame(),
-        'Song': pd.DataFrame(),
-        'Yuan': pd.DataFrame(),
-        'Ming': pd.DataFrame(),
-        'Qing': pd.DataFrame()
-    }
-
-    for filename in os.listdir(folder_path):
+    # one corpus per configured slice (config.SLICES), from the raw files named after its dynasties
+    sources = defaultdict(list)
+    for filename in sorted(os.listdir(folder_path)):
         if filename.endswith('.csv'):
             prefix = filename[0]
 
-            if prefix in dynasty_map:
-                dynasty = dynasty_map[prefix]
-            else:
-                continue
-
-
-            file_path = os.path.join(folder_path, filename)
-            df = pd.read_csv(file_path)
-
-
-            dynasty_data[dynasty] = pd.concat([dynasty_data[dynasty], df])
-
-
-    for dynasty, df in dynasty_data.items():
-        if not df.empty:
-            output_filename = output_path / f'{dynasty}.csv'
-
-            df.to_csv(output_filename, index=False)
-            print(f'Saved {output_filename}')
+            for dynasty, definition in SLICES.items():
+                if prefix in definition['files']:
+                    sources[dynasty].append(folder_path / filename)
+    authors = {dynasty: slice_authors(dynasty) for dynasty in sources}
+
+    manifest = {}
+    for dynasty, paths in sources.items():
+        # union of the source columns, in order of appearance (as pd.concat)
+        columns = []
+        for path in paths:
+            columns.extend(c for c in pd.read_csv(path, nrows=0).columns if c not in columns)
+
+        output_filename = output_path / f'{dynasty}.csv'
+        digest = hashlib.blake2b(digest_size=16)
+        entry = {'file': output_filename.name, 'rows': 0, 'sources': []}
+        # the Parquet copy (one row group per chunk) is written from the same chunks
+        writer = corpus_writer(output_filename, columns)
+        with open(output_filename, 'wb') as f:
+            header = True
+            for path in paths:
+                rows = 0
+                # slices listed before this one that read the same file take their poems first
+                earlier = [other for other in list(SLICES)[:list(SLICES).index(dynasty)]
+                           if path in sources.get(other, [])]
+                # read as text: pandas infers dtypes per chunk, which could write 1 in one chunk and 1.0 in the next
+                for df in pd.read_csv(path, chunksize=chunksize, dtype=str):
+                    if authors[dynasty] is not None or earlier:
+                        keep = slice_rows(df, authors[dynasty], [authors[other] for other in earlier])
+                        df = df[keep]
+                        if df.empty:
+                            continue
+                    df = df.reindex(columns=columns)
+                    data = df.to_csv(index=False, header=header).encode('utf-8')
+                    f.write(data)
+                    if writer is not None:
+                        write_corpus_chunk(writer, df)
+                    digest.update(data)
+                    header = False
+                    rows += len(df)
+                entry['sources'].append({'file': path.name, 'rows': rows, 'digest': file_digest(path)})
+                entry['rows'] += rows
+            if header:
+                data = pd.DataFrame(columns=columns).to_csv(index=False).encode('utf-8')
+                f.write(data)
+                digest.update(data)
+        if writer is not None:
+            writer.close()
+            entry['columnar'] = columnar_path(output_filename).name
+
+        entry['digest'] = digest.hexdigest()
+        stat = output_filename.stat()
+        entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        remember_digest(output_filename, entry['digest'])
+        manifest[dynasty] = entry
+        print(f'Saved {output_filename} ({entry["rows"]} rows)')
+
+    with open(output_path / MANIFEST_NAME, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
 
 if __name__ == "__main__":
     get_dynasty_corpus()